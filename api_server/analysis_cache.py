@@ -0,0 +1,66 @@
+"""
+Short-Lived Analysis Handles
+
+``/analyze`` stores the preprocessed tensor, logits and embedding it already
+computed under an opaque handle, so follow-up calls (``/counterfactual``,
+``/similar-cases``) can reuse that work instead of re-uploading the image and
+repeating preprocessing and the forward pass.
+"""
+
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+class AnalysisStore:
+    """
+    In-memory, TTL-bounded and size-bounded store of analysis results
+
+    Entries expire ``ttl_seconds`` after creation; when more than
+    ``max_entries`` are live, the least recently used one is evicted.
+    """
+
+    def __init__(self, ttl_seconds: float = 600, max_entries: int = 128):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._expire(time.time())
+            return len(self._entries)
+
+    def put(self, entry: Dict) -> str:
+        """Store an analysis result and return its handle"""
+        handle = secrets.token_urlsafe(16)
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            self._entries[handle] = (now + self.ttl_seconds, entry)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return handle
+
+    def get(self, handle: str) -> Optional[Dict]:
+        """Return the analysis behind ``handle``, or None if unknown or expired"""
+        if not isinstance(handle, str):
+            return None
+        now = time.time()
+        with self._lock:
+            item = self._entries.get(handle)
+            if item is None:
+                return None
+            expires_at, entry = item
+            if expires_at <= now:
+                del self._entries[handle]
+                return None
+            self._entries.move_to_end(handle)
+            return entry
+
+    def _expire(self, now: float):
+        expired = [handle for handle, (expires_at, _) in self._entries.items() if expires_at <= now]
+        for handle in expired:
+            del self._entries[handle]
@@ -10,11 +10,12 @@ To run:
 4. Server will start on http://localhost:8000
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 from seaborn import heatmap
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.models as models
 import torchvision.transforms as transforms
 from PIL import Image
@@ -24,6 +25,11 @@ import numpy as np
 import cv2
 import time
 import os
+import functools
+import hashlib
+import hmac
+import signal
+import threading
 from pytorch_grad_cam import GradCAM
 from pytorch_grad_cam.utils.image import show_cam_on_image
 import shap
@@ -31,6 +37,12 @@ import matplotlib.pyplot as plt
 import matplotlib
 matplotlib.use('Agg')  # Use non-interactive backend
 from counterfactual_explainer import CounterfactualExplainer, create_counterfactual_visualizations
+from embedding_store import EmbeddingStore
+from analysis_cache import AnalysisStore
+from profiling import RequestProfiler, StageCostTracker, profile_stage, stage_observer
+from memory_accounting import MemoryTracker
+from mixed_precision import AutocastModel, fp32_activations
+from artifact_encoding import ArtifactEncoder, ArtifactStore, SUPPORTED_FORMATS, SUPPORTED_DELIVERIES, encode_artifacts
 
 
 app = Flask(__name__)
@@ -43,19 +55,118 @@ MODEL_CONFIG = {
     'model_path': 'best.pth'  # <-- Use just the filename if the model is in the same directory as app.py
 }
 
+EMBEDDING_CONFIG = {
+    'store_dir': 'embedding_store',
+    'dim': 1024,  # DenseNet121 pooled feature size in front of model.classifier
+    'default_top_k': 5,
+    'max_top_k': 50,
+    'near_duplicate_threshold': 0.995,  # Minimum cosine similarity of an identical input's stored vector
+    'reuse_explanations': False,  # Default for /analyze `reuse_similar`; only byte-identical inputs are reused
+    'archive_cases': True,  # Add every analyzed case to the store
+    'max_cases': 10000,  # Oldest cases are dropped past this (~150KB of explanation arrays each)
+    'max_age_seconds': 90 * 24 * 3600,  # ...or once they are older than this
+    'flush_interval': 5.0  # Seconds between syncs of the vector file to disk
+}
+
+ARTIFACT_CONFIG = {
+    'store_dir': 'artifact_store',
+    'ttl_seconds': 3600  # Artifacts served by URL are removed after this long
+}
+
+PROFILE_CONFIG = {
+    'output_dir': 'profiles',
+    'token_env': 'DEBUG_PROFILE_TOKEN',  # /debug/profile is disabled unless this env var is set
+    'max_requests': 50,
+    'signal_requests': 5,  # Requests profiled after SIGUSR1
+    'sample_interval': 0.005  # Python stack sampling period in seconds
+}
+
+# Artifacts /analyze can compute on request, and the stages each one pays for
+EXPLAIN_OPTIONS = ['gradcam', 'shap', 'top_features']
+EXPLAIN_COSTS = {
+    'prediction': {
+        'stages': ['preprocessing', 'forward_pass'],
+        'description': 'Label and confidence only; always computed'
+    },
+    'gradcam': {
+        'stages': ['gradcam', 'encode_gradcam'],
+        'description': 'Grad-CAM overlay image'
+    },
+    'shap': {
+        'stages': ['shap', 'encode_shap'],
+        'description': 'SHAP attribution figure (shares the SHAP computation with top_features)'
+    },
+    'top_features': {
+        'stages': ['shap', 'top_features'],
+        'description': 'Top SHAP regions (shares the SHAP computation with shap)'
+    }
+}
+
+# Images /counterfactual can return; only the requested ones are encoded
+COUNTERFACTUAL_ARTIFACTS = ['counterfactual_image', 'perturbation_map', 'difference_map', 'comparison_plot']
+
+WARMUP_CONFIG = {
+    'enabled': True,
+    'corpus_dir': os.path.join('..', 'test'),  # Representative images; synthetic noise if none are found
+    'max_images': 2,
+    'batch_sizes': [1],  # Forward-pass batch sizes to warm; add any sizes used for batching
+    'counterfactual': True,  # Warm the counterfactual methods with shortened runs
+    'background': True  # Warm up in a thread so /health and /ready answer meanwhile
+}
+
+ANALYSIS_CONFIG = {
+    'handle_ttl_seconds': 600,  # How long /analyze results stay reusable by follow-up calls
+    'max_handles': 128  # Each handle holds a preprocessed tensor (~600KB)
+}
+
+PRECISION_CONFIG = {
+    # bf16 autocast for Grad-CAM, SHAP and counterfactual forward/backward passes.
+    # The prediction itself stays fp32; run precision_parity.py before enabling.
+    'mixed_precision': False
+}
+
+MEMORY_CONFIG = {
+    'log_requests': True,  # Print per-request RSS/allocation deltas
+    'per_stage': False,  # Also record deltas per stage (reads /proc twice per stage)
+    'tracemalloc': False,  # Trace Python allocations (adds overhead)
+    'count_tensors': False  # Count live torch tensors per stage (walks the GC heap; soak tests only)
+}
+
 model = None
 shap_explainer = None
 counterfactual_explainer = None
+embedding_store = None
+readiness = {'ready': False, 'status': 'starting', 'warmup': None}
+artifact_store = ArtifactStore(ARTIFACT_CONFIG['store_dir'], ttl_seconds=ARTIFACT_CONFIG['ttl_seconds'])
+analysis_store = AnalysisStore(ANALYSIS_CONFIG['handle_ttl_seconds'], ANALYSIS_CONFIG['max_handles'])
+stage_costs = StageCostTracker()
+request_profiler = RequestProfiler(PROFILE_CONFIG['output_dir'], sample_interval=PROFILE_CONFIG['sample_interval'])
+memory_tracker = MemoryTracker(count_tensors=MEMORY_CONFIG['count_tensors'], log=MEMORY_CONFIG['log_requests'],
+                               per_stage=MEMORY_CONFIG['per_stage'])
+if MEMORY_CONFIG['tracemalloc']:
+    memory_tracker.start_tracing()
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+# ImageNet normalization; the counterfactual explainer clamps to the range it maps [0, 1] to
+NORMALIZE_MEAN = [0.485, 0.456, 0.406]
+NORMALIZE_STD = [0.229, 0.224, 0.225]
+
 transform = transforms.Compose([
     transforms.Resize((MODEL_CONFIG['input_size'], MODEL_CONFIG['input_size'])),
     transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])  # ImageNet normalization
+    transforms.Normalize(mean=NORMALIZE_MEAN, std=NORMALIZE_STD)
 ])
 
+def checkpoint_digest(path):
+    """SHA-256 of a model checkpoint; embeddings are only comparable within one checkpoint"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 def load_model():
-    global model, shap_explainer, counterfactual_explainer
+    global model, shap_explainer, counterfactual_explainer, embedding_store
     if not os.path.exists(MODEL_CONFIG['model_path']):
         raise FileNotFoundError(f"Model file not found: {MODEL_CONFIG['model_path']}")
     try:
@@ -76,7 +187,8 @@ def load_model():
             background_data = torch.randn(5, 3, MODEL_CONFIG['input_size'], MODEL_CONFIG['input_size']).to(device)
             
             # Use GradientExplainer which works better with PyTorch
-            shap_explainer = shap.GradientExplainer(model, background_data)
+            shap_model = AutocastModel(model, device) if PRECISION_CONFIG['mixed_precision'] else model
+            shap_explainer = shap.GradientExplainer(shap_model, background_data)
             print("SHAP explainer initialized successfully")
         except Exception as shap_error:
             print(f"Warning: Failed to initialize SHAP explainer: {shap_error}")
@@ -85,12 +197,34 @@ def load_model():
         # Initialize Counterfactual explainer
         print("Initializing Counterfactual explainer...")
         try:
-            counterfactual_explainer = CounterfactualExplainer(model, device, MODEL_CONFIG['input_size'])
+            counterfactual_explainer = CounterfactualExplainer(
+                model, device, MODEL_CONFIG['input_size'], mixed_precision=PRECISION_CONFIG['mixed_precision'],
+                mean=NORMALIZE_MEAN, std=NORMALIZE_STD
+            )
             print("Counterfactual explainer initialized successfully")
         except Exception as cf_error:
             print(f"Warning: Failed to initialize Counterfactual explainer: {cf_error}")
             counterfactual_explainer = None
         
+        # Initialize embedding store for similar-case retrieval
+        print("Initializing embedding store...")
+        try:
+            # One store per checkpoint: vectors (and cached explanations) from another
+            # model are not comparable, so replacing the model starts a fresh store
+            model_digest = checkpoint_digest(MODEL_CONFIG['model_path'])
+            embedding_store = EmbeddingStore(
+                os.path.join(EMBEDDING_CONFIG['store_dir'], model_digest[:16]),
+                dim=EMBEDDING_CONFIG['dim'],
+                max_cases=EMBEDDING_CONFIG['max_cases'],
+                max_age_seconds=EMBEDDING_CONFIG['max_age_seconds'],
+                flush_interval=EMBEDDING_CONFIG['flush_interval']
+            )
+            print(f"Embedding store initialized with {len(embedding_store)} archived cases "
+                  f"for model {model_digest[:16]}")
+        except Exception as store_error:
+            print(f"Warning: Failed to initialize embedding store: {store_error}")
+            embedding_store = None
+        
         print(f"Model loaded successfully on {device}")
         return True
     except Exception as e:
@@ -109,47 +243,57 @@ def preprocess_image(image_data):
     except Exception as e:
         raise ValueError(f"Error preprocessing image: {str(e)}")
 
-def generate_gradcam(model, input_tensor, target_class=None):
-    """Generate Grad-CAM visualization using pytorch-grad-cam"""
+def generate_gradcam(model, input_tensor, target_class=None, mixed_precision=None):
+    """Generate Grad-CAM overlay and uint8 grayscale heatmap using pytorch-grad-cam"""
     try:
+        if mixed_precision is None:
+            mixed_precision = PRECISION_CONFIG['mixed_precision']
         target_layers = [model.features[-1]]
-        cam = GradCAM(model=model, target_layers=target_layers)
-        # Targets argument can be set for specific class, or None for max score
-        grayscale_cam = cam(input_tensor=input_tensor, targets=None)[0]
-        # Convert input tensor to normalized numpy image
-        img_np = input_tensor.squeeze().cpu().numpy()
-        img_np = np.transpose(img_np, (1, 2, 0))
-        img_norm = (img_np - img_np.min()) / (img_np.max() - img_np.min() + 1e-8)
-        cam_image = show_cam_on_image(img_norm, grayscale_cam, use_rgb=True)
-        return cam_image
+        cam_model = AutocastModel(model, device) if mixed_precision else model
+        # fp32_activations must wrap GradCAM so its hooks see fp32 activations;
+        # the GradCAM context manager removes its hooks when done
+        with fp32_activations(target_layers if mixed_precision else []), \
+                GradCAM(model=cam_model, target_layers=target_layers) as cam:
+            # Targets argument can be set for specific class, or None for max score
+            grayscale_cam = cam(input_tensor=input_tensor, targets=None)[0]
+        return render_gradcam_overlay(input_tensor, grayscale_cam), (grayscale_cam * 255).astype(np.uint8)
     except Exception as e:
         print(f"Grad-CAM generation failed: {str(e)}")
         # Fallback: blank heatmap
-        heatmap = np.zeros((MODEL_CONFIG['input_size'], MODEL_CONFIG['input_size'], 3), dtype=np.uint8)
-        return heatmap
+        size = MODEL_CONFIG['input_size']
+        return np.zeros((size, size, 3), dtype=np.uint8), np.zeros((size, size), dtype=np.uint8)
+
+def render_gradcam_overlay(input_tensor, grayscale_cam):
+    """Blend a Grad-CAM heatmap in [0, 1] (or uint8) onto the image in input_tensor"""
+    if grayscale_cam.dtype == np.uint8:
+        grayscale_cam = grayscale_cam.astype(np.float32) / 255.0
+    # Convert input tensor to normalized numpy image
+    img_np = input_tensor.squeeze().detach().cpu().numpy()
+    img_np = np.transpose(img_np, (1, 2, 0))
+    img_norm = (img_np - img_np.min()) / (img_np.max() - img_np.min() + 1e-8)
+    return show_cam_on_image(img_norm, grayscale_cam, use_rgb=True)
 
-def create_gradcam_overlay(original_image, heatmap):
-    """Create Grad-CAM overlay on original image and return as base64 PNG"""
+def create_gradcam_overlay(original_image, heatmap, encoder=None):
+    """Encode the Grad-CAM overlay (base64 PNG unless another encoding was requested)"""
     try:
-        overlay_image = Image.fromarray(heatmap)
-        buffer = io.BytesIO()
-        overlay_image.save(buffer, format='PNG')
-        overlay_base64 = base64.b64encode(buffer.getvalue()).decode()
-        return overlay_base64
+        encoder = encoder or ArtifactEncoder()
+        return encoder.encode_image(heatmap)
     except Exception as e:
         print(f"Error creating Grad-CAM overlay: {str(e)}")
         return None
 
-def generate_shap_explanation(input_tensor, predicted_class=None):
-    """Generate SHAP explanations for model predictions"""
+def compute_shap_heatmap(input_tensor, predicted_class=None, explainer=None):
+    """Compute a normalized SHAP magnitude heatmap (H, W) for the predicted class"""
     try:
-        if shap_explainer is None:
+        explainer = explainer or shap_explainer
+        if explainer is None:
             print("SHAP explainer not available")
-            return None, None
+            return None
             
-        # Get SHAP values using GradientExplainer
-        input_tensor_grad = input_tensor.requires_grad_(True)
-        shap_values = shap_explainer.shap_values(input_tensor_grad)
+        # Get SHAP values using GradientExplainer on a copy, so the caller's
+        # tensor does not keep requiring grad (and building autograd graphs)
+        input_tensor_grad = input_tensor.detach().clone().requires_grad_(True)
+        shap_values = explainer.shap_values(input_tensor_grad)
         
         # GradientExplainer returns numpy array with shape (batch, channels, height, width, num_classes)
         shap_array = shap_values
@@ -177,39 +321,301 @@ def generate_shap_explanation(input_tensor, predicted_class=None):
         
         # Normalize for visualization
         shap_heatmap = (shap_heatmap - shap_heatmap.min()) / (shap_heatmap.max() - shap_heatmap.min() + 1e-8)
-        
-        # Create SHAP visualization
-        plt.figure(figsize=(8, 6))
-        plt.imshow(shap_heatmap, cmap='RdBu_r', alpha=0.8)
-        plt.colorbar(label='SHAP Value Magnitude')
-        plt.title(f'SHAP Explanation - Class {predicted_class}')
-        plt.axis('off')
-        
-        # Save to base64
-        buffer = io.BytesIO()
-        plt.savefig(buffer, format='PNG', bbox_inches='tight', dpi=150)
-        plt.close()
-        shap_image_base64 = base64.b64encode(buffer.getvalue()).decode()
-        
-        # Calculate feature importance scores
-        top_features = []
-        flattened_shap = shap_heatmap.flatten()
-        top_indices = np.argsort(flattened_shap)[-10:][::-1]  # Top 10 most important pixels
-        
-        for idx in top_indices:
-            row, col = divmod(idx, shap_heatmap.shape[1])
-            importance = flattened_shap[idx]
-            top_features.append({
-                'position': {'row': int(row), 'col': int(col)},
-                'importance': float(importance),
-                'region': f"Region ({row}, {col})"
-            })
-        
-        return shap_image_base64, top_features
+        return shap_heatmap
         
     except Exception as e:
         print(f"SHAP explanation generation failed: {str(e)}")
+        return None
+
+def render_shap_image(shap_heatmap, predicted_class=None, encoder=None):
+    """Render a SHAP heatmap figure (base64 PNG unless another encoding was requested)"""
+    try:
+        encoder = encoder or ArtifactEncoder()
+        fig = plt.figure(figsize=(8, 6))
+        try:
+            plt.imshow(shap_heatmap, cmap='RdBu_r', alpha=0.8)
+            plt.colorbar(label='SHAP Value Magnitude')
+            plt.title(f'SHAP Explanation - Class {predicted_class}')
+            plt.axis('off')
+            return encoder.encode_figure(fig)
+        finally:
+            # Always release the figure; pyplot keeps open figures alive
+            plt.close(fig)
+    except Exception as e:
+        print(f"Error rendering SHAP explanation: {str(e)}")
+        return None
+
+def compute_top_features(shap_heatmap, count=10):
+    """Return the most important pixels of a SHAP heatmap"""
+    top_features = []
+    flattened_shap = shap_heatmap.flatten()
+    top_indices = np.argsort(flattened_shap)[-count:][::-1]  # Top 10 most important pixels
+    
+    for idx in top_indices:
+        row, col = divmod(idx, shap_heatmap.shape[1])
+        importance = flattened_shap[idx]
+        top_features.append({
+            'position': {'row': int(row), 'col': int(col)},
+            'importance': float(importance),
+            'region': f"Region ({row}, {col})"
+        })
+    return top_features
+
+def generate_shap_explanation(input_tensor, predicted_class=None):
+    """Generate SHAP explanations for model predictions"""
+    shap_heatmap = compute_shap_heatmap(input_tensor, predicted_class)
+    if shap_heatmap is None:
+        return None, None
+    return render_shap_image(shap_heatmap, predicted_class), compute_top_features(shap_heatmap)
+
+def forward_with_embedding(model, input_tensor):
+    """Run DenseNet121 and also return the pooled features fed to model.classifier"""
+    features = model.features(input_tensor)
+    pooled = F.adaptive_avg_pool2d(F.relu(features), (1, 1))
+    embedding = torch.flatten(pooled, 1)
+    return model.classifier(embedding), embedding
+
+def parse_options(value, allowed, field, empty=('', 'none')):
+    """Parse a list or comma-separated request field into a subset of `allowed` (default: all)"""
+    if value is None:
+        return set(allowed)
+    if isinstance(value, str):
+        value = value.split(',')
+    if not isinstance(value, (list, tuple)):
+        raise ValueError(f"{field} must be a list or comma-separated string")
+    # Sentinels such as 'none' mean "nothing", in a string or a list alike
+    options = {str(option).strip().lower() for option in value} - set(empty)
+    unknown = options - set(allowed)
+    if unknown:
+        raise ValueError(f"Unknown {field} options {sorted(unknown)}, expected any of {allowed}")
+    return options
+
+def explain_costs():
+    """Typical cost of each explain option, measured from recent requests"""
+    costs = {}
+    for option, spec in EXPLAIN_COSTS.items():
+        costs[option] = {
+            'typical_ms': stage_costs.typical_ms(*spec['stages']),
+            'samples': min(stage_costs.samples(stage) for stage in spec['stages']),
+            'description': spec['description']
+        }
+    return costs
+
+def resolve_analysis(data):
+    """
+    Return the preprocessed tensor, logits and embedding for a follow-up request,
+    reusing a stored /analyze result when an analysis handle is given
+    """
+    handle = data.get('analysis_handle')
+    if handle is not None:
+        entry = analysis_store.get(handle)
+        if entry is None:
+            raise LookupError('Analysis handle not found or expired')
+        return entry
+    with profile_stage('preprocessing'):
+        input_tensor, _ = preprocess_image(data['image'])
+    with profile_stage('forward_pass'), torch.no_grad():
+        logits, embedding = forward_with_embedding(model, input_tensor)
+    return {'input_tensor': input_tensor, 'logits': logits, 'embedding': embedding[0].cpu().numpy()}
+
+def input_digest(input_tensor):
+    """SHA-256 of the preprocessed input; identifies exact repeats of a study"""
+    return hashlib.sha256(input_tensor.detach().cpu().numpy().tobytes()).hexdigest()
+
+def find_identical_case(embedding, input_hash):
+    """Return the archived case with the identical preprocessed input, if any (hash lookup, no scan)"""
+    if embedding_store is None:
+        return None
+    try:
+        return embedding_store.find_identical(input_hash, embedding)
+    except Exception as e:
+        print(f"Similar-case lookup failed: {str(e)}")
+        return None
+
+def find_near_duplicate(hit, predicted_class):
+    """
+    Return the cached explanation of an identical archived case, if it can be reused
+
+    Pooled embeddings discard spatial layout, so similarity alone is never enough
+    to reuse another case's explanation; ``hit`` must come from ``find_identical_case``.
+    """
+    if hit is None or hit['similarity'] < EMBEDDING_CONFIG['near_duplicate_threshold']:
         return None, None
+    record = hit['record']
+    if record.get('prediction_index') != predicted_class or not record.get('has_explanation'):
+        return None, None
+    explanation = embedding_store.load_explanation(record['case_id'])
+    if explanation is None:
+        return None, None
+    return hit, explanation
+
+def archive_case(embedding, predicted_class, probabilities, explanation, input_hash=None):
+    """Archive an analyzed case in the embedding store; returns its case id"""
+    if embedding_store is None or not EMBEDDING_CONFIG['archive_cases']:
+        return None
+    try:
+        return embedding_store.add(embedding, {
+            'prediction': MODEL_CONFIG['class_names'][predicted_class],
+            'prediction_index': predicted_class,
+            'confidence': float(max(probabilities)),
+            'probabilities': probabilities,
+            'input_hash': input_hash
+        }, explanation)
+    except Exception as e:
+        print(f"Error archiving case: {str(e)}")
+        return None
+
+def load_warmup_images():
+    """Base64 images for warmup: the configured corpus, or synthetic noise"""
+    images = []
+    corpus_dir = WARMUP_CONFIG['corpus_dir']
+    if os.path.isdir(corpus_dir):
+        for name in sorted(os.listdir(corpus_dir)):
+            if name.lower().endswith(('.png', '.jpg', '.jpeg')):
+                with open(os.path.join(corpus_dir, name), 'rb') as f:
+                    images.append(base64.b64encode(f.read()).decode())
+            if len(images) >= WARMUP_CONFIG['max_images']:
+                break
+    if not images:
+        noise = np.random.RandomState(0).randint(0, 256, (512, 512), dtype=np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(noise).save(buffer, format='PNG')
+        images.append(base64.b64encode(buffer.getvalue()).decode())
+    return images
+
+def warmup_steps(image_data):
+    """The request paths to warm for one image, as (stage name, callable) pairs"""
+    state = {}
+
+    def preprocess():
+        state['input_tensor'], _ = preprocess_image(image_data)
+
+    def forward():
+        with torch.no_grad():
+            for batch_size in WARMUP_CONFIG['batch_sizes']:
+                batch = state['input_tensor'].repeat(batch_size, 1, 1, 1)
+                outputs, embedding = forward_with_embedding(model, batch)
+        state['predicted_class'] = outputs[:1].argmax(dim=1).item()
+        state['embedding'] = embedding[0].cpu().numpy()
+
+    def gradcam():
+        state['heatmap'], _ = generate_gradcam(model, state['input_tensor'], state['predicted_class'])
+
+    def encode_gradcam():
+        create_gradcam_overlay(None, state['heatmap'])
+
+    def shap_values():
+        state['shap_heatmap'] = compute_shap_heatmap(state['input_tensor'], state['predicted_class'])
+
+    def encode_shap():
+        if state['shap_heatmap'] is not None:
+            render_shap_image(state['shap_heatmap'], state['predicted_class'])
+
+    def top_features():
+        if state['shap_heatmap'] is not None:
+            compute_top_features(state['shap_heatmap'])
+
+    def similar_cases():
+        embedding_store.search(state['embedding'], k=EMBEDDING_CONFIG['default_top_k'])
+
+    def counterfactual():
+        target_class = 1 - state['predicted_class']
+        counterfactual_explainer.generate_adversarial_counterfactual(state['input_tensor'], target_class, iterations=2)
+        counterfactual_explainer.generate_gradient_based_counterfactual(state['input_tensor'], target_class, iterations=2)
+        counterfactual_explainer.generate_mask_based_counterfactual(state['input_tensor'], target_class, mask_size=112)
+
+    steps = [
+        ('preprocessing', preprocess),
+        ('forward_pass', forward),
+        ('gradcam', gradcam),
+        ('encode_gradcam', encode_gradcam),
+    ]
+    if shap_explainer is not None:
+        steps += [('shap', shap_values), ('encode_shap', encode_shap), ('top_features', top_features)]
+    if embedding_store is not None:
+        steps.append(('similar_cases', similar_cases))
+    if counterfactual_explainer is not None and WARMUP_CONFIG['counterfactual']:
+        steps.append(('counterfactual', counterfactual))
+    return steps
+
+def run_warmup():
+    """
+    Run representative images through every enabled path before marking the
+    server ready, and log how much slower the cold pass was than the warm one
+    """
+    if not WARMUP_CONFIG['enabled']:
+        readiness.update(ready=True, status='ready', warmup={'skipped': True})
+        return
+    readiness.update(ready=False, status='warming_up')
+    print("Warming up model and explainers...")
+    start = time.perf_counter()
+    try:
+        images = load_warmup_images()
+        cold, warm = {}, {}
+
+        # Cold pass: first image only, so every path pays its one-time setup here
+        for name, step in warmup_steps(images[0]):
+            step_start = time.perf_counter()
+            step()
+            cold[name] = (time.perf_counter() - step_start) * 1000.0
+
+        # Warm pass over all images; these timings also seed /model-info costs
+        with stage_observer(stage_costs):
+            for image_data in images:
+                for name, step in warmup_steps(image_data):
+                    step_start = time.perf_counter()
+                    with profile_stage(name):
+                        step()
+                    warm.setdefault(name, []).append((time.perf_counter() - step_start) * 1000.0)
+
+        paths = {}
+        for name, cold_ms in cold.items():
+            warm_ms = sum(warm[name]) / len(warm[name])
+            paths[name] = {'cold_ms': cold_ms, 'warm_ms': warm_ms, 'cold_to_warm': cold_ms / warm_ms if warm_ms > 0 else None}
+            print(f"  warmup {name:<15} cold {cold_ms:9.1f}ms  warm {warm_ms:9.1f}ms  ({cold_ms - warm_ms:+.1f}ms)")
+        total_cold = sum(cold.values())
+        total_warm = sum(path['warm_ms'] for path in paths.values())
+        print(f"Warmup finished in {time.perf_counter() - start:.1f}s: "
+              f"cold request path {total_cold:.0f}ms vs warm {total_warm:.0f}ms")
+        readiness.update(ready=True, status='ready', warmup={
+            'images': len(images),
+            'batch_sizes': WARMUP_CONFIG['batch_sizes'],
+            'duration_s': time.perf_counter() - start,
+            'cold_total_ms': total_cold,
+            'warm_total_ms': total_warm,
+            'paths': paths
+        })
+    except Exception as e:
+        import traceback
+        print("Warmup failed:", traceback.format_exc())
+        readiness.update(ready=False, status='warmup_failed', warmup={'error': str(e)})
+
+def start_warmup():
+    """Start warmup in the background or inline, per WARMUP_CONFIG"""
+    if WARMUP_CONFIG['background']:
+        threading.Thread(target=run_warmup, name='warmup', daemon=True).start()
+    else:
+        run_warmup()
+
+def requires_ready(view):
+    """
+    Answer 503 until warmup has finished
+
+    Warmup runs Grad-CAM and SHAP on the shared model; a concurrent request's
+    Grad-CAM hooks would collect the warmup image's activations (or vice versa).
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not readiness['ready']:
+            response = jsonify({
+                'error': 'Server is not ready',
+                'status': readiness['status'] if model is not None else 'model_not_loaded'
+            })
+            response.status_code = 503
+            response.headers['Retry-After'] = '5'
+            return response
+        return view(*args, **kwargs)
+    return wrapper
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -217,11 +623,27 @@ def health_check():
     return jsonify({
         'status': 'healthy',
         'model_loaded': model is not None,
+        'ready': readiness['ready'],
         'device': str(device),
         'timestamp': time.time()
     })
 
+@app.route('/ready', methods=['GET'])
+def ready_check():
+    """Readiness endpoint: 200 once warmup has finished, 503 before"""
+    body = {
+        'ready': readiness['ready'] and model is not None,
+        'status': readiness['status'] if model is not None else 'model_not_loaded',
+        'warmup': readiness['warmup'],
+        'timestamp': time.time()
+    }
+    return jsonify(body), 200 if body['ready'] else 503
+
 @app.route('/analyze', methods=['POST'])
+@requires_ready
+@request_profiler.profiled('analyze')
+@memory_tracker.tracked('analyze')
+@stage_costs.tracked
 def analyze_xray():
     """Main analysis endpoint"""
     start_time = time.time()
@@ -232,25 +654,102 @@ def analyze_xray():
         if not data or 'image' not in data:
             return jsonify({'error': 'No image data provided'}), 400
 
+        try:
+            encoder = ArtifactEncoder.from_request(data, artifact_store)
+            explain = parse_options(data.get('explain'), EXPLAIN_OPTIONS, 'explain',
+                                    empty=('', 'none', 'prediction'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
         # Preprocess image for model
-        input_tensor, original_image = preprocess_image(data['image'])
+        with profile_stage('preprocessing'):
+            input_tensor, original_image = preprocess_image(data['image'])
 
         # Inference
-        with torch.no_grad():
-            outputs = model(input_tensor)
+        with profile_stage('forward_pass'), torch.no_grad():
+            outputs, embedding = forward_with_embedding(model, input_tensor)
             probabilities = torch.softmax(outputs, dim=1)
             confidence, predicted = torch.max(probabilities, 1)
             predicted_class = predicted.item()
             confidence_score = confidence.item()
+        embedding_np = embedding[0].cpu().numpy()
+        input_hash = input_digest(input_tensor)
+
+        # Keep this work around for follow-up calls such as /counterfactual
+        analysis_entry = {
+            'input_tensor': input_tensor,
+            'logits': outputs,
+            'embedding': embedding_np,
+            'case_id': None
+        }
+        analysis_handle = analysis_store.put(analysis_entry)
+
+        # A repeat of an archived input is not archived again
+        identical_case = find_identical_case(embedding_np, input_hash)
+
+        # Opt-in: an archived case with the identical input reuses its stored explanations
+        need_gradcam = 'gradcam' in explain
+        need_shap = 'shap' in explain or 'top_features' in explain
+        similar_hit, cached_explanation = None, None
+        if (need_gradcam or need_shap) and data.get('reuse_similar', EMBEDDING_CONFIG['reuse_explanations']):
+            similar_hit, cached_explanation = find_near_duplicate(identical_case, predicted_class)
+        cached_explanation = cached_explanation or {}
+
+        # Only compute what the client asked for
+        heatmap, gradcam_cam, shap_heatmap = None, None, None
+        if need_gradcam:
+            if 'gradcam_cam' in cached_explanation:
+                # Only the grayscale CAM is archived; blend it onto this request's image.
+                # Timed separately so the cheap blend does not skew the gradcam cost estimate
+                gradcam_cam = cached_explanation['gradcam_cam']
+                with profile_stage('gradcam_reused'):
+                    heatmap = render_gradcam_overlay(input_tensor, gradcam_cam)
+            else:
+                # Generate Grad-CAM
+                with profile_stage('gradcam'):
+                    heatmap, gradcam_cam = generate_gradcam(model, input_tensor, predicted_class)
+        if need_shap:
+            if 'shap_heatmap' in cached_explanation:
+                shap_heatmap = cached_explanation['shap_heatmap'].astype(np.float32)
+            else:
+                # Generate SHAP heatmap
+                with profile_stage('shap'):
+                    shap_heatmap = compute_shap_heatmap(input_tensor, predicted_class)
 
-        # Generate Grad-CAM
-        heatmap = generate_gradcam(model, input_tensor, predicted_class)
+        # Encode Grad-CAM overlay in the negotiated format
+        gradcam_overlay = None
+        if heatmap is not None:
+            with profile_stage('encode_gradcam_raw' if encoder.is_raw else 'encode_gradcam'):
+                gradcam_overlay = create_gradcam_overlay(original_image.resize((MODEL_CONFIG['input_size'], MODEL_CONFIG['input_size'])), heatmap, encoder)
 
-        # Convert Grad-CAM to base64 PNG
-        gradcam_overlay = create_gradcam_overlay(original_image.resize((MODEL_CONFIG['input_size'], MODEL_CONFIG['input_size'])), heatmap)
+        # Render SHAP explanations; raw clients get the float16 attribution map instead of a figure
+        shap_image, shap_attribution, shap_features = None, None, None
+        if shap_heatmap is not None:
+            if 'shap' in explain:
+                # Raw arrays skip figure rendering; keep them out of the encode_shap estimate
+                if encoder.is_raw:
+                    with profile_stage('encode_shap_raw'):
+                        shap_attribution = encoder.encode_array(shap_heatmap)
+                else:
+                    with profile_stage('encode_shap'):
+                        shap_image = render_shap_image(shap_heatmap, predicted_class, encoder)
+            if 'top_features' in explain:
+                with profile_stage('top_features'):
+                    shap_features = compute_top_features(shap_heatmap)
 
-        # Generate SHAP explanations
-        shap_image, shap_features = generate_shap_explanation(input_tensor, predicted_class)
+        # Archive new cases for similar-case retrieval
+        if identical_case is not None:
+            case_id = identical_case['record']['case_id']
+        else:
+            explanation = {}
+            if gradcam_cam is not None:
+                explanation['gradcam_cam'] = gradcam_cam
+            if shap_heatmap is not None:
+                explanation['shap_heatmap'] = shap_heatmap.astype(np.float16)
+            case_id = archive_case(embedding_np, predicted_class, probabilities[0].cpu().numpy().tolist(),
+                                   explanation, input_hash)
+        # /similar-cases with this handle must not return the query's own archived case
+        analysis_entry['case_id'] = case_id
 
         # Prepare response
         prediction_label = MODEL_CONFIG['class_names'][predicted_class]
@@ -262,13 +761,22 @@ def analyze_xray():
             'confidence': confidence_score,
             'processing_time': processing_time,
             'gradcam_image': gradcam_overlay,
+            'explained': [option for option in EXPLAIN_OPTIONS if option in explain],
             'shap_explanation': {
-                'available': shap_image is not None,
+                'available': shap_heatmap is not None,
                 'image': shap_image,
                 'top_features': shap_features if shap_features else [],
                 'description': 'SHAP values explain which regions of the image contributed most to the model\'s prediction'
             },
             'counterfactual_available': counterfactual_explainer is not None,
+            'artifact_encoding': encoder.describe(),
+            'analysis_handle': analysis_handle,
+            'analysis_handle_expires_in': ANALYSIS_CONFIG['handle_ttl_seconds'],
+            'case_id': case_id,
+            'near_duplicate': {
+                'case_id': similar_hit['record']['case_id'],
+                'similarity': similar_hit['similarity']
+            } if similar_hit is not None else None,
             'model_info': {
                 'architecture': 'DenseNet121',
                 'input_size': MODEL_CONFIG['input_size'],
@@ -276,6 +784,11 @@ def analyze_xray():
             },
             'timestamp': time.time()
         }
+        if encoder.is_raw:
+            if 'shap' in explain:
+                response['shap_explanation']['attribution_map'] = shap_attribution
+            if gradcam_cam is not None:
+                response['gradcam_heatmap'] = encoder.encode_array(gradcam_cam)
         return jsonify(response)
 
     except Exception as e:
@@ -287,6 +800,9 @@ def analyze_xray():
         }), 500
 
 @app.route('/counterfactual', methods=['POST'])
+@requires_ready
+@request_profiler.profiled('counterfactual')
+@memory_tracker.tracked('counterfactual')
 def generate_counterfactual():
     """Generate counterfactual explanations for an X-ray image"""
     start_time = time.time()
@@ -298,27 +814,40 @@ def generate_counterfactual():
             return jsonify({'error': 'Counterfactual explainer not available'}), 500
             
         data = request.get_json()
-        if not data or 'image' not in data:
-            return jsonify({'error': 'No image data provided'}), 400
+        if not data or ('image' not in data and 'analysis_handle' not in data):
+            return jsonify({'error': 'No image data or analysis handle provided'}), 400
 
-        # Preprocess image
-        input_tensor, original_image = preprocess_image(data['image'])
+        try:
+            encoder = ArtifactEncoder.from_request(data, artifact_store)
+            artifacts = parse_options(data.get('artifacts'), COUNTERFACTUAL_ARTIFACTS, 'artifacts')
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
-        # Get original prediction
-        with torch.no_grad():
-            outputs = model(input_tensor)
-            probabilities = torch.softmax(outputs, dim=1)
-            confidence, predicted = torch.max(probabilities, 1)
-            predicted_class = predicted.item()
+        # Reuse the /analyze result if a handle was sent, otherwise preprocess and predict
+        try:
+            analysis = resolve_analysis(data)
+        except LookupError as e:
+            return jsonify({'error': str(e)}), 404
+        input_tensor, outputs = analysis['input_tensor'], analysis['logits']
+        probabilities = torch.softmax(outputs, dim=1)
+        confidence, predicted = torch.max(probabilities, 1)
+        predicted_class = predicted.item()
 
         # Generate comprehensive counterfactuals
         print(f"Generating counterfactual explanations for class {predicted_class}...")
         counterfactual_results = counterfactual_explainer.generate_comprehensive_counterfactuals(
-            input_tensor, predicted_class
+            input_tensor, predicted_class, original_logits=outputs
         )
 
-        # Create visualizations
-        visualizations = create_counterfactual_visualizations(counterfactual_results)
+        # Create visualizations from the in-memory artifacts
+        visualizations = {}
+        if 'comparison_plot' in artifacts:
+            with profile_stage('counterfactual_visualization'):
+                visualizations = create_counterfactual_visualizations(counterfactual_results, encoder)
+
+        # Encode once, and only the artifacts the client asked for
+        with profile_stage('counterfactual_encoding'):
+            counterfactual_results = encode_artifacts(counterfactual_results, encoder, include=artifacts)
 
         # Prepare response
         processing_time = time.time() - start_time
@@ -332,6 +861,7 @@ def generate_counterfactual():
             },
             'counterfactual_results': counterfactual_results,
             'visualizations': visualizations,
+            'artifact_encoding': encoder.describe(),
             'processing_time': processing_time,
             'explanation': {
                 'purpose': 'Counterfactual explanations show what would need to change in the X-ray for the AI to predict differently',
@@ -355,6 +885,111 @@ def generate_counterfactual():
             'processing_time': time.time() - start_time
         }), 500
 
+@app.route('/similar-cases', methods=['POST'])
+@requires_ready
+@request_profiler.profiled('similar_cases')
+@memory_tracker.tracked('similar_cases')
+def similar_cases():
+    """Retrieve the most similar archived cases for an X-ray image"""
+    start_time = time.time()
+    try:
+        if model is None:
+            return jsonify({'error': 'Model not loaded'}), 500
+
+        if embedding_store is None:
+            return jsonify({'error': 'Embedding store not available'}), 500
+
+        data = request.get_json()
+        if not data or ('image' not in data and 'analysis_handle' not in data):
+            return jsonify({'error': 'No image data or analysis handle provided'}), 400
+
+        try:
+            k = int(data.get('k', EMBEDDING_CONFIG['default_top_k']))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'k must be an integer'}), 400
+        k = max(1, min(k, EMBEDDING_CONFIG['max_top_k']))
+
+        try:
+            analysis = resolve_analysis(data)
+        except LookupError as e:
+            return jsonify({'error': str(e)}), 404
+        probabilities = torch.softmax(analysis['logits'], dim=1)
+        confidence, predicted = torch.max(probabilities, 1)
+        predicted_class = predicted.item()
+
+        # A handle's own archived case would always be the top hit; leave it out
+        own_case_id = analysis.get('case_id')
+        hits = embedding_store.search(analysis['embedding'], k=k + 1 if own_case_id else k)
+        hits = [hit for hit in hits if hit['record']['case_id'] != own_case_id][:k]
+        similar = []
+        for hit in hits:
+            record = hit['record']
+            similar.append({
+                'case_id': record['case_id'],
+                'similarity': hit['similarity'],
+                'near_duplicate': hit['similarity'] >= EMBEDDING_CONFIG['near_duplicate_threshold'],
+                'prediction': record.get('prediction'),
+                'prediction_index': record.get('prediction_index'),
+                'confidence': record.get('confidence'),
+                'probabilities': record.get('probabilities'),
+                'archived_at': record.get('archived_at')
+            })
+
+        return jsonify({
+            'query_prediction': {
+                'class': MODEL_CONFIG['class_names'][predicted_class],
+                'class_index': predicted_class,
+                'confidence': confidence.item()
+            },
+            'similar_cases': similar,
+            'archived_cases': len(embedding_store),
+            'processing_time': time.time() - start_time,
+            'timestamp': time.time()
+        })
+
+    except Exception as e:
+        import traceback
+        print("Exception in /similar-cases:", traceback.format_exc())
+        return jsonify({
+            'error': str(e),
+            'processing_time': time.time() - start_time
+        }), 500
+
+@app.route('/artifacts/<artifact_id>', methods=['GET'])
+def get_artifact(artifact_id):
+    """Serve an explanation artifact stored for URL delivery"""
+    path = artifact_store.path(artifact_id)
+    if path is None:
+        return jsonify({'error': 'Artifact not found or expired'}), 404
+    return send_file(path, max_age=ARTIFACT_CONFIG['ttl_seconds'])
+
+@app.route('/debug/profile', methods=['GET', 'POST'])
+def debug_profile():
+    """Arm torch.profiler + stack sampling for the next N requests (token protected)"""
+    token = os.environ.get(PROFILE_CONFIG['token_env'])
+    if not token:
+        return jsonify({'error': 'Profiling endpoint disabled'}), 404
+    if not hmac.compare_digest(request.headers.get('X-Debug-Token', ''), token):
+        return jsonify({'error': 'Invalid debug token'}), 403
+
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            requests_to_profile = int(data.get('requests', 1))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'requests must be an integer'}), 400
+        if not 0 <= requests_to_profile <= PROFILE_CONFIG['max_requests']:
+            return jsonify({'error': f"requests must be between 0 and {PROFILE_CONFIG['max_requests']}"}), 400
+        request_profiler.arm(requests_to_profile)
+        print(f"Profiling armed for the next {requests_to_profile} requests")
+
+    return jsonify(request_profiler.status())
+
+def handle_profile_signal(signum, frame):
+    """SIGUSR1 arms profiling for a few requests without going through HTTP"""
+    request_profiler.arm(PROFILE_CONFIG['signal_requests'])
+    print(f"Profiling armed for the next {PROFILE_CONFIG['signal_requests']} requests (SIGUSR1)")
+
 @app.route('/model-info', methods=['GET'])
 def model_info():
     """Get model information"""
@@ -372,27 +1007,45 @@ def model_info():
         'model_loaded': model is not None,
         'shap_available': shap_explainer is not None,
         'counterfactual_available': counterfactual_explainer is not None,
+        'archived_cases': len(embedding_store) if embedding_store is not None else 0,
         'explainability_methods': explainability_methods,
+        'explain_options': explain_costs(),
+        'explainer_precision': 'bf16-autocast' if PRECISION_CONFIG['mixed_precision'] else 'fp32',
+        'artifact_formats': SUPPORTED_FORMATS,
+        'artifact_deliveries': SUPPORTED_DELIVERIES,
+        'counterfactual_artifacts': COUNTERFACTUAL_ARTIFACTS,
         'endpoints': {
-            '/analyze': 'Analyze X-ray image with basic explanations',
-            '/counterfactual': 'Generate counterfactual explanations',
+            '/analyze': 'Analyze X-ray image; `explain` selects gradcam, shap and top_features',
+            '/counterfactual': 'Generate counterfactual explanations; `artifacts` selects the images returned',
+            '/similar-cases': 'Retrieve the most similar archived cases',
+            '/artifacts/<artifact_id>': 'Fetch an artifact returned by URL',
             '/health': 'Health check',
+            '/ready': 'Readiness; 503 until warmup has finished',
             '/model-info': 'Model information'
         }
     })
 
 if __name__ == '__main__':
     print("Starting Fracture Detection API Server...")
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, handle_profile_signal)
     print(f"Device: {device}")
+    debug = True
     if load_model():
         print("Model loaded successfully!")
+        # The debug reloader runs this block in a watcher process and again in the
+        # serving child; only the process that serves requests needs warming
+        if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            start_warmup()
         print(f"Server starting on http://localhost:8000")
         print("\nAPI Endpoints:")
         print("- POST /analyze - Analyze X-ray image")
         print("- POST /counterfactual - Generate counterfactual explanations")
+        print("- POST /similar-cases - Retrieve similar archived cases")
         print("- GET /health - Health check")
+        print("- GET /ready - Readiness (warmup finished)")
         print("- GET /model-info - Model information")
         print("\nMake sure to place your 'best.pth' file in this directory!")
-        app.run(host='0.0.0.0', port=8000, debug=True)
+        app.run(host='0.0.0.0', port=8000, debug=debug)
     else:
         print("Failed to load model. Please check your model file and try again.")
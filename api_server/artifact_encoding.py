@@ -0,0 +1,253 @@
+"""
+Artifact Encoding and Format Negotiation for Explanation Outputs
+
+Explanation responses carry several images (Grad-CAM overlay, SHAP figure,
+counterfactual images and difference maps). Clients can choose how they are
+delivered:
+- ``png`` (default), ``webp`` or ``jpeg`` images at a chosen quality
+- ``raw`` arrays: uint8 images/heatmaps and float16 attribution maps
+- ``inline`` base64 payloads or ``url`` references into a local artifact store
+
+Inside a request, artifacts travel as array-backed ``Artifact`` objects and
+are encoded once, at the response boundary, by ``encode_artifacts``.
+"""
+
+import base64
+import io
+import os
+import re
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+from PIL import Image
+
+
+IMAGE_FORMATS = {
+    'png': {'pil_format': 'PNG', 'mime_type': 'image/png', 'extension': 'png'},
+    'webp': {'pil_format': 'WEBP', 'mime_type': 'image/webp', 'extension': 'webp'},
+    'jpeg': {'pil_format': 'JPEG', 'mime_type': 'image/jpeg', 'extension': 'jpg'},
+}
+RAW_FORMAT = 'raw'
+SUPPORTED_FORMATS = list(IMAGE_FORMATS) + [RAW_FORMAT]
+SUPPORTED_DELIVERIES = ['inline', 'url']
+
+_ARTIFACT_ID_PATTERN = re.compile(r'^[0-9a-f]{32}\.(png|webp|jpg|npy)$')
+
+
+class Artifact:
+    """
+    Array-backed explanation artifact
+
+    Holds a float16 (H, W) or (H, W, C) view of a [0, 1]-scaled tensor. ``kind``
+    is ``image`` for pictures (sent as uint8) or ``attribution`` for difference
+    and perturbation maps (sent as float16 to raw clients).
+    """
+
+    def __init__(self, array: np.ndarray, kind: str = 'image'):
+        self.array = array
+        self.kind = kind
+
+    @classmethod
+    def from_tensor(cls, tensor, kind: str = 'image') -> 'Artifact':
+        """Build from a (1, C, H, W) or (C, H, W) torch tensor"""
+        array = tensor.detach().squeeze().cpu().half().numpy()
+        if array.ndim == 3:  # (C, H, W)
+            array = np.transpose(array, (1, 2, 0))
+        return cls(array, kind)
+
+    def to_uint8(self) -> np.ndarray:
+        return (np.clip(self.array.astype(np.float32), 0, 1) * 255).astype(np.uint8)
+
+
+def encode_artifacts(value, encoder: 'ArtifactEncoder', include: Optional[Iterable[str]] = None):
+    """
+    Replace every ``Artifact`` in a nested dict/list with its encoded form
+
+    Artifacts whose dict key is not in ``include`` (when given) are dropped
+    without being encoded.
+    """
+    if isinstance(value, Artifact):
+        return encoder.encode_artifact(value)
+    if isinstance(value, dict):
+        return {
+            key: encode_artifacts(item, encoder, include)
+            for key, item in value.items()
+            if not (isinstance(item, Artifact) and include is not None and key not in include)
+        }
+    if isinstance(value, (list, tuple)):
+        return [encode_artifacts(item, encoder, include) for item in value]
+    return value
+
+
+class ArtifactStore:
+    """
+    Local directory of encoded artifacts served back by URL
+
+    Artifacts older than ``ttl_seconds`` are removed on the next write.
+    """
+
+    def __init__(self, store_dir: str, ttl_seconds: float = 3600, url_prefix: str = '/artifacts/'):
+        # Absolute, because Flask's send_file resolves relative paths against app.root_path
+        self.store_dir = os.path.abspath(store_dir)
+        self.ttl_seconds = ttl_seconds
+        self.url_prefix = url_prefix
+        self._lock = threading.Lock()
+        self._last_cleanup = 0.0
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    def put(self, payload: bytes, extension: str) -> str:
+        """Write an artifact and return its URL"""
+        artifact_id = f'{uuid.uuid4().hex}.{extension}'
+        with open(os.path.join(self.store_dir, artifact_id), 'wb') as f:
+            f.write(payload)
+        self._cleanup()
+        return self.url_prefix + artifact_id
+
+    def path(self, artifact_id: str) -> Optional[str]:
+        """Resolve an artifact id to a file path, or None if unknown or expired"""
+        if not _ARTIFACT_ID_PATTERN.match(artifact_id):
+            return None
+        path = os.path.join(self.store_dir, artifact_id)
+        try:
+            # Cleanup only runs on writes, so expired files may still be on disk
+            if time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                return None
+        except OSError:
+            return None
+        return path
+
+    def _cleanup(self):
+        now = time.time()
+        with self._lock:
+            if now - self._last_cleanup < min(self.ttl_seconds, 60):
+                return
+            self._last_cleanup = now
+        for name in os.listdir(self.store_dir):
+            path = os.path.join(self.store_dir, name)
+            try:
+                if now - os.path.getmtime(path) > self.ttl_seconds:
+                    os.remove(path)
+            except OSError:
+                continue
+
+
+class ArtifactEncoder:
+    """
+    Encode explanation artifacts in the representation a client asked for
+    """
+
+    def __init__(self,
+                 format: str = 'png',
+                 quality: int = 80,
+                 delivery: str = 'inline',
+                 artifact_store: Optional[ArtifactStore] = None,
+                 figure_dpi: int = 150):
+        if format not in SUPPORTED_FORMATS:
+            raise ValueError(f"Unsupported artifact format '{format}', expected one of {SUPPORTED_FORMATS}")
+        if delivery not in SUPPORTED_DELIVERIES:
+            raise ValueError(f"Unsupported artifact delivery '{delivery}', expected one of {SUPPORTED_DELIVERIES}")
+        if delivery == 'url' and artifact_store is None:
+            raise ValueError("Artifact delivery 'url' requires an artifact store")
+        if not 1 <= quality <= 100:
+            raise ValueError("Artifact quality must be between 1 and 100")
+        self.format = format
+        self.quality = quality
+        self.delivery = delivery
+        self.artifact_store = artifact_store
+        self.figure_dpi = figure_dpi
+
+    @classmethod
+    def from_request(cls, data: Dict, artifact_store: Optional[ArtifactStore] = None) -> 'ArtifactEncoder':
+        """Build an encoder from the ``artifact_*`` fields of a request body"""
+        try:
+            quality = int(data.get('artifact_quality', 80))
+        except (TypeError, ValueError):
+            raise ValueError("Artifact quality must be an integer")
+        return cls(
+            format=str(data.get('artifact_format', 'png')).lower(),
+            quality=quality,
+            delivery=str(data.get('artifact_delivery', 'inline')).lower(),
+            artifact_store=artifact_store
+        )
+
+    @property
+    def is_raw(self) -> bool:
+        return self.format == RAW_FORMAT
+
+    def describe(self) -> Dict:
+        """Describe the negotiated encoding so clients can decode artifacts"""
+        description = {
+            'format': self.format,
+            'delivery': self.delivery,
+        }
+        if self.is_raw:
+            description['mime_type'] = 'application/octet-stream'
+            description['layout'] = 'row-major, channels last'
+        else:
+            description['mime_type'] = IMAGE_FORMATS[self.format]['mime_type']
+            if self.format != 'png':
+                description['quality'] = self.quality
+        return description
+
+    def encode_image(self, image: np.ndarray):
+        """
+        Encode a uint8 image (H, W) or (H, W, 3)
+
+        Returns a base64 string (or URL) for image formats and a raw array
+        payload for ``raw``.
+        """
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        if self.is_raw:
+            return self.encode_array(image)
+
+        spec = IMAGE_FORMATS[self.format]
+        pil_image = Image.fromarray(image)
+        if self.format == 'jpeg' and pil_image.mode not in ('RGB', 'L'):
+            pil_image = pil_image.convert('RGB')
+        buffer = io.BytesIO()
+        if self.format == 'png':
+            pil_image.save(buffer, format=spec['pil_format'])
+        else:
+            pil_image.save(buffer, format=spec['pil_format'], quality=self.quality)
+        return self._deliver(buffer.getvalue(), spec['extension'])
+
+    def encode_array(self, array: np.ndarray):
+        """Encode a uint8 or float16 array (other float types are cast to float16)"""
+        array = np.asarray(array)
+        if array.dtype != np.uint8:
+            array = array.astype(np.float16)
+        array = np.ascontiguousarray(array)
+        if self.delivery == 'url':
+            buffer = io.BytesIO()
+            np.save(buffer, array)
+            return self.artifact_store.put(buffer.getvalue(), 'npy')
+        return {
+            'dtype': str(array.dtype),
+            'shape': list(array.shape),
+            'data': base64.b64encode(array.tobytes()).decode()
+        }
+
+    def encode_figure(self, fig):
+        """Encode a matplotlib figure; PNG keeps the original savefig output"""
+        if self.format == 'png':
+            buffer = io.BytesIO()
+            fig.savefig(buffer, format='PNG', bbox_inches='tight', dpi=self.figure_dpi)
+            return self._deliver(buffer.getvalue(), 'png')
+        fig.set_dpi(self.figure_dpi)
+        fig.canvas.draw()
+        rgba = np.asarray(fig.canvas.buffer_rgba())
+        return self.encode_image(rgba[:, :, :3])
+
+    def encode_artifact(self, artifact: Artifact):
+        """Encode an ``Artifact``; raw clients get attribution maps as float16"""
+        if self.is_raw and artifact.kind == 'attribution':
+            return self.encode_array(artifact.array)
+        return self.encode_image(artifact.to_uint8())
+
+    def _deliver(self, payload: bytes, extension: str) -> str:
+        if self.delivery == 'url':
+            return self.artifact_store.put(payload, extension)
+        return base64.b64encode(payload).decode()
@@ -11,14 +11,14 @@ import torch
 import torch.nn.functional as F
 import numpy as np
 import cv2
-from PIL import Image
 import matplotlib.pyplot as plt
 import matplotlib
 matplotlib.use('Agg')
-import io
-import base64
-from typing import Tuple, List, Dict, Optional
+from typing import Any, Tuple, List, Dict, Optional
 import warnings
+from artifact_encoding import Artifact, ArtifactEncoder
+from profiling import profile_stage
+from mixed_precision import autocast
 warnings.filterwarnings('ignore')
 
 
@@ -27,18 +27,36 @@ class CounterfactualExplainer:
     Generate counterfactual explanations for medical image classification
     """
     
-    def __init__(self, model, device='cpu', target_size=224):
+    def __init__(self, model, device='cpu', target_size=224, mixed_precision=False, mean=None, std=None):
         self.model = model
         self.device = device
         self.target_size = target_size
+        # bf16 autocast for forward/backward passes; optimized tensors stay fp32
+        self.mixed_precision = mixed_precision
+        # Valid input range: [0, 1] pixels, mapped through the normalization if one is given
+        mean = torch.tensor(mean if mean is not None else [0.0], dtype=torch.float32).view(1, -1, 1, 1)
+        std = torch.tensor(std if std is not None else [1.0], dtype=torch.float32).view(1, -1, 1, 1)
+        self.lower = ((0.0 - mean) / std).to(device)
+        self.upper = ((1.0 - mean) / std).to(device)
         self.model.eval()
+    
+    def _clamp_to_valid(self, tensor: torch.Tensor) -> torch.Tensor:
+        """Clamp a (normalized) image tensor to the range real pixel values map to"""
+        return torch.max(torch.min(tensor, self.upper), self.lower)
+    
+    def _forward(self, tensor: torch.Tensor) -> torch.Tensor:
+        """Model logits in fp32, computed under bf16 autocast in mixed-precision mode"""
+        with autocast(self.device, self.mixed_precision):
+            output = self.model(tensor)
+        return output.float()
         
     def generate_adversarial_counterfactual(self, 
                                           input_tensor: torch.Tensor,
                                           target_class: int,
                                           epsilon: float = 0.1,
                                           alpha: float = 0.01,
-                                          iterations: int = 100) -> Dict:
+                                          iterations: int = 100,
+                                          original_prediction: Optional[Dict] = None) -> Dict:
         """
         Generate adversarial counterfactual using iterative perturbation
         
@@ -48,14 +66,15 @@ class CounterfactualExplainer:
             epsilon: Maximum perturbation magnitude
             alpha: Step size for each iteration
             iterations: Maximum number of iterations
+            original_prediction: Already computed prediction for input_tensor, reused if given
             
         Returns:
-            Dictionary containing counterfactual results
+            Dictionary containing counterfactual results; images are
+            ``Artifact`` objects, encoded later by the caller
         """
         input_tensor = input_tensor.clone().detach().to(self.device)
-        input_tensor.requires_grad_(True)
         
-        original_pred = self._get_prediction(input_tensor)
+        original_pred = original_prediction or self._get_prediction(input_tensor)
         
         # If already predicting target class, return original
         if original_pred['predicted_class'] == target_class:
@@ -67,14 +86,14 @@ class CounterfactualExplainer:
                 'perturbation_magnitude': 0.0
             }
         
-        # Initialize perturbation
-        perturbation = torch.zeros_like(input_tensor)
+        # Initialize perturbation (the only tensor we need gradients for)
+        perturbation = torch.zeros_like(input_tensor, requires_grad=True)
         best_perturbation = None
         best_confidence = 0.0
         
         for i in range(iterations):
             # Forward pass
-            output = self.model(input_tensor + perturbation)
+            output = self._forward(input_tensor + perturbation)
             current_pred = F.softmax(output, dim=1)
             
             # Check if we've achieved target class
@@ -84,7 +103,7 @@ class CounterfactualExplainer:
             if predicted_class == target_class:
                 if target_confidence > best_confidence:
                     best_confidence = target_confidence
-                    best_perturbation = perturbation.clone()
+                    best_perturbation = perturbation.detach().clone()
                     
                 # Early stopping if high confidence
                 if target_confidence > 0.8:
@@ -99,23 +118,23 @@ class CounterfactualExplainer:
             # Update perturbation using gradient descent
             with torch.no_grad():
                 grad_sign = perturbation.grad.sign()
-                perturbation -= alpha * grad_sign
+                updated = perturbation - alpha * grad_sign
                 
                 # Clip perturbation to epsilon ball
-                perturbation = torch.clamp(perturbation, -epsilon, epsilon)
+                updated = torch.clamp(updated, -epsilon, epsilon)
                 
-                # Ensure perturbed image is in valid range [0, 1]
-                perturbed_image = input_tensor + perturbation
-                perturbation = torch.clamp(perturbed_image, 0, 1) - input_tensor
+                # Ensure perturbed image maps to valid pixels (stays inside the epsilon ball)
+                perturbed_image = self._clamp_to_valid(input_tensor + updated)
+                updated = perturbed_image - input_tensor
                 
-            # Zero gradients
-            perturbation.grad = None
+            # Fresh leaf for the next step (drops the old gradient and graph)
+            perturbation = updated.requires_grad_(True)
         
         # Use best perturbation found
         if best_perturbation is not None:
             final_perturbation = best_perturbation
         else:
-            final_perturbation = perturbation
+            final_perturbation = perturbation.detach()
             
         # Generate final results
         counterfactual_image = input_tensor + final_perturbation
@@ -130,8 +149,8 @@ class CounterfactualExplainer:
             'success': success,
             'original_prediction': original_pred,
             'counterfactual_prediction': final_pred,
-            'counterfactual_image': self._tensor_to_base64(counterfactual_image),
-            'perturbation_map': self._tensor_to_base64(final_perturbation),
+            'counterfactual_image': self._to_artifact(counterfactual_image),
+            'perturbation_map': self._to_artifact(final_perturbation, kind='attribution'),
             'perturbation_magnitude': perturbation_magnitude,
             'iterations_used': i + 1,
             'confidence_improvement': final_pred['confidence'] - original_pred['confidence'] if success else 0.0
@@ -140,7 +159,9 @@ class CounterfactualExplainer:
     def generate_gradient_based_counterfactual(self,
                                              input_tensor: torch.Tensor,
                                              target_class: int,
-                                             lambda_reg: float = 0.1) -> Dict:
+                                             lambda_reg: float = 0.1,
+                                             iterations: int = 200,
+                                             original_prediction: Optional[Dict] = None) -> Dict:
         """
         Generate counterfactual using gradient-based optimization
         """
@@ -152,16 +173,16 @@ class CounterfactualExplainer:
         
         optimizer = torch.optim.Adam([counterfactual], lr=0.01)
         
-        original_pred = self._get_prediction(input_tensor)
+        original_pred = original_prediction or self._get_prediction(input_tensor)
         
         best_loss = float('inf')
         best_counterfactual = None
         
-        for iteration in range(200):
+        for iteration in range(iterations):
             optimizer.zero_grad()
             
             # Forward pass
-            output = self.model(counterfactual)
+            output = self._forward(counterfactual)
             pred_probs = F.softmax(output, dim=1)
             
             # Loss components
@@ -185,7 +206,7 @@ class CounterfactualExplainer:
             
             # Clamp to valid image range
             with torch.no_grad():
-                counterfactual.clamp_(0, 1)
+                counterfactual.copy_(self._clamp_to_valid(counterfactual))
             
             # Early stopping if target achieved
             predicted_class = torch.argmax(pred_probs, dim=1).item()
@@ -211,8 +232,8 @@ class CounterfactualExplainer:
             'method': 'gradient_optimization',
             'original_prediction': original_pred,
             'counterfactual_prediction': final_pred,
-            'counterfactual_image': self._tensor_to_base64(final_counterfactual),
-            'difference_map': self._tensor_to_base64(difference),
+            'counterfactual_image': self._to_artifact(final_counterfactual),
+            'difference_map': self._to_artifact(difference, kind='attribution'),
             'perturbation_magnitude': perturbation_magnitude,
             'iterations_used': iteration + 1,
             'final_loss': best_loss
@@ -221,12 +242,13 @@ class CounterfactualExplainer:
     def generate_mask_based_counterfactual(self,
                                          input_tensor: torch.Tensor,
                                          target_class: int,
-                                         mask_size: int = 32) -> Dict:
+                                         mask_size: int = 32,
+                                         original_prediction: Optional[Dict] = None) -> Dict:
         """
         Generate counterfactual by systematically masking image regions
         """
         input_tensor = input_tensor.clone().detach().to(self.device)
-        original_pred = self._get_prediction(input_tensor)
+        original_pred = original_prediction or self._get_prediction(input_tensor)
         
         h, w = input_tensor.shape[-2:]
         best_result = None
@@ -264,8 +286,8 @@ class CounterfactualExplainer:
                 'method': 'mask_based',
                 'original_prediction': original_pred,
                 'counterfactual_prediction': best_result['prediction'],
-                'counterfactual_image': self._tensor_to_base64(best_result['counterfactual_image']),
-                'difference_map': self._tensor_to_base64(difference),
+                'counterfactual_image': self._to_artifact(best_result['counterfactual_image']),
+                'difference_map': self._to_artifact(difference, kind='attribution'),
                 'mask_position': best_result['mask_position'],
                 'confidence_achieved': best_confidence
             }
@@ -279,42 +301,60 @@ class CounterfactualExplainer:
     
     def generate_comprehensive_counterfactuals(self,
                                              input_tensor: torch.Tensor,
-                                             original_class: int) -> Dict:
+                                             original_class: int,
+                                             original_logits: Optional[torch.Tensor] = None) -> Dict:
         """
         Generate multiple types of counterfactual explanations
+        
+        Pass ``original_logits`` from an earlier forward pass on ``input_tensor``
+        to skip recomputing the original prediction in every method. Images in
+        the results are ``Artifact`` objects; encode them with
+        ``artifact_encoding.encode_artifacts`` at the response boundary.
         """
         target_class = 1 - original_class  # Flip between 0 (normal) and 1 (fracture)
         
+        if original_logits is not None:
+            original_prediction = self.prediction_from_logits(original_logits)
+        else:
+            original_prediction = self._get_prediction(input_tensor)
+        
         results = {
             'original_class': original_class,
             'target_class': target_class,
-            'original_prediction': self._get_prediction(input_tensor),
+            'precision': 'bf16-autocast' if self.mixed_precision else 'fp32',
+            'original_prediction': original_prediction,
             'counterfactuals': {}
         }
         
         # Method 1: Adversarial perturbation
         try:
-            adv_result = self.generate_adversarial_counterfactual(
-                input_tensor, target_class, epsilon=0.1
-            )
+            with profile_stage('counterfactual_adversarial'):
+                adv_result = self.generate_adversarial_counterfactual(
+                    input_tensor, target_class, epsilon=0.1,
+                    original_prediction=original_prediction
+                )
             results['counterfactuals']['adversarial'] = adv_result
         except Exception as e:
             results['counterfactuals']['adversarial'] = {'error': str(e)}
         
         # Method 2: Gradient optimization
         try:
-            grad_result = self.generate_gradient_based_counterfactual(
-                input_tensor, target_class
-            )
+            with profile_stage('counterfactual_gradient_optimization'):
+                grad_result = self.generate_gradient_based_counterfactual(
+                    input_tensor, target_class,
+                    original_prediction=original_prediction
+                )
             results['counterfactuals']['gradient_optimization'] = grad_result
         except Exception as e:
             results['counterfactuals']['gradient_optimization'] = {'error': str(e)}
         
         # Method 3: Mask-based
         try:
-            mask_result = self.generate_mask_based_counterfactual(
-                input_tensor, target_class
-            )
+            with profile_stage('counterfactual_mask_based'):
+                mask_result = self.generate_mask_based_counterfactual(
+                    input_tensor, target_class,
+                    original_prediction=original_prediction
+                )
             results['counterfactuals']['mask_based'] = mask_result
         except Exception as e:
             results['counterfactuals']['mask_based'] = {'error': str(e)}
@@ -337,8 +377,14 @@ class CounterfactualExplainer:
     def _get_prediction(self, tensor: torch.Tensor) -> Dict:
         """Get model prediction for a tensor"""
         with torch.no_grad():
-            output = self.model(tensor)
-            probabilities = F.softmax(output, dim=1)
+            output = self._forward(tensor)
+        return self.prediction_from_logits(output)
+    
+    @staticmethod
+    def prediction_from_logits(logits: torch.Tensor) -> Dict:
+        """Build the prediction dict from model logits of shape (1, num_classes)"""
+        with torch.no_grad():
+            probabilities = F.softmax(logits.float(), dim=1)
             predicted_class = torch.argmax(probabilities, dim=1).item()
             confidence = probabilities[0, predicted_class].item()
             
@@ -348,34 +394,9 @@ class CounterfactualExplainer:
                 'probabilities': probabilities[0].cpu().numpy().tolist()
             }
     
-    def _tensor_to_base64(self, tensor: torch.Tensor) -> str:
-        """Convert tensor to base64 encoded PNG"""
-        try:
-            # Convert to numpy and normalize
-            img_np = tensor.squeeze().cpu().detach().numpy()
-            
-            if len(img_np.shape) == 3:  # (C, H, W)
-                img_np = np.transpose(img_np, (1, 2, 0))
-            
-            # Normalize to 0-255
-            img_np = (img_np * 255).astype(np.uint8)
-            
-            # Convert to PIL Image
-            if len(img_np.shape) == 3 and img_np.shape[2] == 3:
-                img = Image.fromarray(img_np, 'RGB')
-            else:
-                img = Image.fromarray(img_np, 'L')
-            
-            # Convert to base64
-            buffer = io.BytesIO()
-            img.save(buffer, format='PNG')
-            img_base64 = base64.b64encode(buffer.getvalue()).decode()
-            
-            return img_base64
-            
-        except Exception as e:
-            print(f"Error converting tensor to base64: {e}")
-            return ""
+    def _to_artifact(self, tensor: torch.Tensor, kind: str = 'image') -> Artifact:
+        """Keep tensor as an in-memory float16 artifact (no encoding yet)"""
+        return Artifact.from_tensor(tensor, kind)
     
     def _find_best_method(self, counterfactuals: Dict) -> Optional[str]:
         """Find the best counterfactual method based on success and quality"""
@@ -398,11 +419,16 @@ class CounterfactualExplainer:
         return best_method
 
 
-def create_counterfactual_visualizations(counterfactual_results: Dict) -> Dict[str, str]:
+def create_counterfactual_visualizations(counterfactual_results: Dict,
+                                         encoder: Optional[ArtifactEncoder] = None) -> Dict[str, Any]:
     """
     Create visualization plots for counterfactual explanations
+
+    Expects the un-encoded results of ``generate_comprehensive_counterfactuals``.
     """
     visualizations = {}
+    encoder = encoder or ArtifactEncoder()
+    fig = None
     
     try:
         # Create comparison plot
@@ -418,10 +444,9 @@ def create_counterfactual_visualizations(counterfactual_results: Dict) -> Dict[s
         row = 0
         for method_name, result in counterfactual_results['counterfactuals'].items():
             if isinstance(result, dict) and result.get('success', False):
-                # Decode images
+                # Plot straight from the in-memory artifacts
                 try:
-                    cf_img_data = base64.b64decode(result['counterfactual_image'])
-                    cf_img = Image.open(io.BytesIO(cf_img_data))
+                    cf_img = result['counterfactual_image'].to_uint8()
                     
                     # Plot counterfactual image
                     axes[row, 0].imshow(cf_img, cmap='gray')
@@ -430,8 +455,7 @@ def create_counterfactual_visualizations(counterfactual_results: Dict) -> Dict[s
                     
                     # Plot difference/perturbation map if available
                     if 'difference_map' in result:
-                        diff_img_data = base64.b64decode(result['difference_map'])
-                        diff_img = Image.open(io.BytesIO(diff_img_data))
+                        diff_img = result['difference_map'].to_uint8()
                         axes[row, 1].imshow(diff_img, cmap='hot')
                         axes[row, 1].set_title('Difference Map')
                         axes[row, 1].axis('off')
@@ -477,17 +501,17 @@ def create_counterfactual_visualizations(counterfactual_results: Dict) -> Dict[s
             for j in range(3):
                 axes[i, j].remove()
         
-        plt.tight_layout()
-        
-        # Convert to base64
-        buffer = io.BytesIO()
-        plt.savefig(buffer, format='PNG', dpi=150, bbox_inches='tight')
-        plt.close()
+        fig.tight_layout()
         
-        visualizations['comparison_plot'] = base64.b64encode(buffer.getvalue()).decode()
+        # Encode in the negotiated format (base64 PNG by default)
+        visualizations['comparison_plot'] = encoder.encode_figure(fig)
         
     except Exception as e:
         print(f"Error creating visualizations: {e}")
         visualizations['error'] = str(e)
+    finally:
+        # Close even on failure so pyplot does not keep the figure alive
+        if fig is not None:
+            plt.close(fig)
     
     return visualizations
@@ -0,0 +1,261 @@
+"""
+Embedding Store for Similar-Case Retrieval
+
+Keeps the 1024-dimensional DenseNet121 penultimate features computed during
+every analysis so that prior cases can be looked up again:
+- Compact float16 vectors in a memory-mapped file
+- Flat inner-product index over L2-normalized vectors (cosine similarity)
+- Stored prediction metadata and the explanation arrays of each case
+- Bounded retention: the oldest cases are dropped past a size or age cap
+
+Vectors are only comparable within one model, so callers should give each
+model checkpoint its own ``store_dir`` (see ``app.load_model``).
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+class EmbeddingStore:
+    """
+    On-disk store of case embeddings with top-k retrieval
+
+    Cases are appended in arrival order. Once more than ``max_cases`` are
+    stored (or the oldest is older than ``max_age_seconds``), the oldest are
+    removed in one compaction that keeps 90% of the cap, so the rewrite cost
+    is amortized over many additions. The vector memmap is synced to disk when
+    it grows and at most every ``flush_interval`` seconds; a crashed process
+    still leaves its writes in the page cache, so only a host crash can lose
+    the last interval.
+
+    Layout of ``store_dir``:
+        embeddings.f16      raw float16 matrix, one row per case
+        records.jsonl       one JSON record per case, same order as the rows
+        explanations/       per-case ``.npz`` with Grad-CAM and SHAP arrays
+
+    Records may carry an ``input_hash`` (digest of the preprocessed input);
+    ``find_identical`` uses it to recognise a repeat of the exact same input.
+    """
+
+    def __init__(self,
+                 store_dir: str,
+                 dim: int = 1024,
+                 initial_capacity: int = 1024,
+                 max_cases: Optional[int] = None,
+                 max_age_seconds: Optional[float] = None,
+                 flush_interval: float = 5.0):
+        self.store_dir = store_dir
+        self.dim = dim
+        self.max_cases = max_cases
+        self.max_age_seconds = max_age_seconds
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        self._last_age_check = 0.0
+        self._vectors_path = os.path.join(store_dir, 'embeddings.f16')
+        self._records_path = os.path.join(store_dir, 'records.jsonl')
+        self._explanations_dir = os.path.join(store_dir, 'explanations')
+        os.makedirs(self._explanations_dir, exist_ok=True)
+
+        self._records = self._load_records()
+
+        existing_rows = 0
+        if os.path.exists(self._vectors_path):
+            existing_rows = os.path.getsize(self._vectors_path) // (dim * 2)
+        if existing_rows < len(self._records):
+            # Records are only written after their vector, so this means the
+            # vector file was truncated; keep the rows we can still trust.
+            self._records = self._records[:existing_rows]
+        self._index_records()
+        self._capacity = max(initial_capacity, existing_rows)
+        self._vectors = self._open_vectors(self._capacity)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def add(self,
+            embedding: np.ndarray,
+            record: Dict,
+            explanation: Optional[Dict[str, np.ndarray]] = None) -> str:
+        """
+        Archive a case embedding together with its prediction record
+
+        Args:
+            embedding: 1-D feature vector of length ``dim``
+            record: JSON-serializable prediction metadata
+            explanation: Optional arrays (e.g. grayscale Grad-CAM, SHAP heatmap)
+
+        Returns:
+            The generated case id
+        """
+        vector = self._normalize(embedding)
+        case_id = uuid.uuid4().hex
+        record = dict(record, case_id=case_id, archived_at=time.time())
+
+        with self._lock:
+            if explanation:
+                np.savez(os.path.join(self._explanations_dir, f'{case_id}.npz'), **explanation)
+                record['has_explanation'] = True
+
+            row = len(self._records)
+            if row >= self._capacity:
+                self._grow(self._capacity * 2)
+            self._vectors[row] = vector.astype(np.float16)
+
+            with open(self._records_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            self._records.append(record)
+            self._ids[case_id] = row
+            if record.get('input_hash'):
+                self._hashes[record['input_hash']] = row
+
+            self._enforce_retention(record['archived_at'])
+            if record['archived_at'] - self._last_flush >= self.flush_interval:
+                self._flush()
+
+        return case_id
+
+    def flush(self):
+        """Sync the vector file to disk"""
+        with self._lock:
+            self._flush()
+
+    def search(self, embedding: np.ndarray, k: int = 5, chunk_size: int = 8192) -> List[Dict]:
+        """
+        Return the ``k`` most similar archived cases by cosine similarity
+        """
+        query = self._normalize(embedding)
+        with self._lock:
+            count = len(self._records)
+            if count == 0 or k <= 0:
+                return []
+            scores = np.empty(count, dtype=np.float32)
+            for start in range(0, count, chunk_size):
+                end = min(start + chunk_size, count)
+                block = np.asarray(self._vectors[start:end], dtype=np.float32)
+                scores[start:end] = block @ query
+            records = self._records[:count]
+
+        k = min(k, count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            {'similarity': float(scores[row]), 'record': records[row]}
+            for row in top
+        ]
+
+    def nearest(self, embedding: np.ndarray) -> Optional[Dict]:
+        """Return the single most similar archived case, if any"""
+        hits = self.search(embedding, k=1)
+        return hits[0] if hits else None
+
+    def find_identical(self, input_hash: str, embedding: np.ndarray) -> Optional[Dict]:
+        """
+        Return the archived case with exactly this ``input_hash``, if any
+
+        The hit has the same shape as a ``search`` result; its similarity is
+        computed against the stored vector as a consistency check.
+        """
+        query = self._normalize(embedding)
+        with self._lock:
+            row = self._hashes.get(input_hash)
+            if row is None:
+                return None
+            vector = np.asarray(self._vectors[row], dtype=np.float32)
+            record = self._records[row]
+        return {'similarity': float(vector @ query), 'record': record}
+
+    def load_explanation(self, case_id: str) -> Optional[Dict[str, np.ndarray]]:
+        """Load the explanation arrays stored for a case"""
+        path = os.path.join(self._explanations_dir, f'{case_id}.npz')
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                return {name: data[name] for name in data.files}
+        except Exception as e:
+            print(f"Error loading explanation for case {case_id}: {e}")
+            return None
+
+    def _normalize(self, embedding: np.ndarray) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if vector.shape[0] != self.dim:
+            raise ValueError(f"Expected embedding of size {self.dim}, got {vector.shape[0]}")
+        return vector / (np.linalg.norm(vector) + 1e-8)
+
+    def _index_records(self):
+        self._ids = {record['case_id']: row for row, record in enumerate(self._records)}
+        self._hashes = {
+            record['input_hash']: row for row, record in enumerate(self._records) if record.get('input_hash')
+        }
+
+    def _flush(self):
+        self._vectors.flush()
+        self._last_flush = time.time()
+
+    def _enforce_retention(self, now: float):
+        """Drop the oldest cases past the size or age cap (caller holds the lock)"""
+        count = len(self._records)
+        drop = 0
+        if self.max_cases is not None and count > self.max_cases:
+            drop = count - int(self.max_cases * 0.9)
+        # Records are in arrival order, so expired ones form a prefix; check at most once a minute
+        if self.max_age_seconds is not None and now - self._last_age_check >= 60:
+            self._last_age_check = now
+            cutoff = now - self.max_age_seconds
+            expired = 0
+            while expired < count and self._records[expired].get('archived_at', 0) < cutoff:
+                expired += 1
+            drop = max(drop, expired)
+        if drop:
+            self._compact(drop)
+
+    def _compact(self, drop: int):
+        """Remove the ``drop`` oldest cases and their explanation files"""
+        count = len(self._records)
+        dropped, kept = self._records[:drop], self._records[drop:]
+        self._vectors[:count - drop] = np.array(self._vectors[drop:count])
+        self._flush()
+
+        tmp_path = self._records_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for record in kept:
+                f.write(json.dumps(record) + '\n')
+        os.replace(tmp_path, self._records_path)
+        self._records = kept
+        self._index_records()
+
+        for record in dropped:
+            try:
+                os.remove(os.path.join(self._explanations_dir, f"{record['case_id']}.npz"))
+            except OSError:
+                continue
+
+    def _load_records(self) -> List[Dict]:
+        records = []
+        if os.path.exists(self._records_path):
+            with open(self._records_path) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        records.append(json.loads(line))
+        return records
+
+    def _open_vectors(self, capacity: int) -> np.memmap:
+        size = capacity * self.dim * 2
+        with open(self._vectors_path, 'ab') as f:
+            if f.tell() < size:
+                f.truncate(size)
+        return np.memmap(self._vectors_path, dtype=np.float16, mode='r+', shape=(capacity, self.dim))
+
+    def _grow(self, capacity: int):
+        self._vectors.flush()
+        del self._vectors
+        self._capacity = capacity
+        self._vectors = self._open_vectors(capacity)
@@ -0,0 +1,352 @@
+"""
+Load Testing Harness for the Fracture Detection API
+
+Replays X-ray images against a running server and reports throughput,
+latency percentiles and error rates:
+- Closed loop: a fixed number of concurrent clients sending back-to-back
+- Open loop: requests issued at a target rate, independent of responses
+- Mixed endpoint ratios, e.g. ``analyze=0.8,counterfactual=0.2``
+- Step mode that raises the load until the latency curve reaches its knee
+
+Only the standard library is used, so it runs fully offline.
+
+Examples:
+    python load_test.py --mode closed --concurrency 4 --duration 30
+    python load_test.py --mode open --rps 2 --mix analyze=0.8,counterfactual=0.2
+    python load_test.py --mode closed --find-knee --start 1 --step 1 --max-load 32
+"""
+
+import argparse
+import base64
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp')
+ENDPOINTS = {
+    'analyze': '/analyze',
+    'counterfactual': '/counterfactual',
+    'similar': '/similar-cases',
+}
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1', '0.0.0.0')
+
+
+def load_corpus(path: str) -> List[str]:
+    """Load every image under ``path`` as a base64 string"""
+    images = []
+    for root, _, files in os.walk(path):
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                with open(os.path.join(root, name), 'rb') as f:
+                    images.append(base64.b64encode(f.read()).decode())
+    if not images:
+        raise ValueError(f"No images found in {path}")
+    return images
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """Parse ``name=weight,...`` into normalized endpoint weights"""
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint '{name}', expected one of {list(ENDPOINTS)}")
+        weights[name] = float(weight) if weight else 1.0
+    total = sum(weights.values())
+    if total <= 0:
+        raise ValueError("Endpoint mix weights must sum to a positive value")
+    return {name: weight / total for name, weight in weights.items()}
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile of ``values``"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+class RequestRecorder:
+    """Thread-safe collection of per-request outcomes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = []
+
+    def record(self, endpoint: str, latency: float, ok: bool, error: Optional[str] = None):
+        with self._lock:
+            self.samples.append((endpoint, latency, ok, error))
+
+    def summarize(self, elapsed: float) -> Dict:
+        with self._lock:
+            samples = list(self.samples)
+        summary = self._summarize(samples, elapsed)
+        summary['endpoints'] = {}
+        for endpoint in sorted({sample[0] for sample in samples}):
+            summary['endpoints'][endpoint] = self._summarize(
+                [sample for sample in samples if sample[0] == endpoint], elapsed
+            )
+        return summary
+
+    @staticmethod
+    def _summarize(samples, elapsed: float) -> Dict:
+        latencies = [sample[1] for sample in samples if sample[2]]
+        errors = [sample for sample in samples if not sample[2]]
+        error_kinds = {}
+        for sample in errors:
+            error_kinds[sample[3]] = error_kinds.get(sample[3], 0) + 1
+        return {
+            'requests': len(samples),
+            'successes': len(latencies),
+            'errors': len(errors),
+            'error_rate': len(errors) / len(samples) if samples else 0.0,
+            'error_kinds': error_kinds,
+            'throughput_rps': len(latencies) / elapsed if elapsed > 0 else 0.0,
+            'p50_ms': _to_ms(percentile(latencies, 50)),
+            'p95_ms': _to_ms(percentile(latencies, 95)),
+            'p99_ms': _to_ms(percentile(latencies, 99)),
+        }
+
+
+def _to_ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else seconds * 1000.0
+
+
+class LoadGenerator:
+    """
+    Drive a running API server with replayed images
+    """
+
+    def __init__(self,
+                 base_url: str,
+                 images: List[str],
+                 mix: Dict[str, float],
+                 timeout: float = 120.0,
+                 extra_payload: Optional[Dict] = None,
+                 seed: int = 0):
+        self.base_url = base_url.rstrip('/')
+        self.images = images
+        self.mix = mix
+        self.timeout = timeout
+        self.extra_payload = extra_payload or {}
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+
+    def _next_request(self):
+        with self._random_lock:
+            endpoint = self._random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+            image = self._random.choice(self.images)
+        payload = dict(self.extra_payload, image=image)
+        return endpoint, json.dumps(payload).encode()
+
+    def _send(self, endpoint: str, body: bytes, recorder: RequestRecorder, scheduled_at: float):
+        req = urllib.request.Request(
+            self.base_url + ENDPOINTS[endpoint],
+            data=body,
+            headers={'Content-Type': 'application/json'},
+            method='POST'
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                response.read()
+            recorder.record(endpoint, time.perf_counter() - scheduled_at, True)
+        except urllib.error.HTTPError as e:
+            recorder.record(endpoint, time.perf_counter() - scheduled_at, False, f'http_{e.code}')
+        except Exception as e:
+            recorder.record(endpoint, time.perf_counter() - scheduled_at, False, type(e).__name__)
+
+    def run_closed_loop(self, concurrency: int, duration: float) -> Dict:
+        """Run ``concurrency`` clients that each send the next request as soon as one completes"""
+        recorder = RequestRecorder()
+        deadline = time.perf_counter() + duration
+
+        def client():
+            while time.perf_counter() < deadline:
+                endpoint, body = self._next_request()
+                self._send(endpoint, body, recorder, time.perf_counter())
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        summary = recorder.summarize(time.perf_counter() - started)
+        summary.update({'mode': 'closed', 'load': concurrency})
+        return summary
+
+    def run_open_loop(self, rps: float, duration: float, max_in_flight: int = 256, poisson: bool = False) -> Dict:
+        """
+        Issue requests at ``rps`` regardless of how fast the server answers
+
+        Latency is measured from each request's scheduled send time, so
+        queueing in the client while the server is saturated is not hidden.
+        Requests that would exceed ``max_in_flight`` are counted as dropped.
+        """
+        recorder = RequestRecorder()
+        in_flight = threading.Semaphore(max_in_flight)
+        arrivals = random.Random(1)
+
+        def send(endpoint, body, scheduled_at):
+            try:
+                self._send(endpoint, body, recorder, scheduled_at)
+            finally:
+                in_flight.release()
+
+        started = time.perf_counter()
+        next_at = started
+        with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+            while next_at < started + duration:
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                endpoint, body = self._next_request()
+                if in_flight.acquire(blocking=False):
+                    pool.submit(send, endpoint, body, next_at)
+                else:
+                    recorder.record(endpoint, 0.0, False, 'dropped')
+                next_at += arrivals.expovariate(rps) if poisson else 1.0 / rps
+        summary = recorder.summarize(time.perf_counter() - started)
+        summary.update({'mode': 'open', 'load': rps})
+        return summary
+
+    def run(self, mode: str, load: float, duration: float, **kwargs) -> Dict:
+        if mode == 'closed':
+            return self.run_closed_loop(int(load), duration)
+        return self.run_open_loop(load, duration, **kwargs)
+
+    def find_knee(self,
+                  mode: str,
+                  start: float,
+                  step: float,
+                  max_load: float,
+                  duration: float,
+                  latency_factor: float = 2.0,
+                  min_throughput_gain: float = 0.05,
+                  max_error_rate: float = 0.01,
+                  **kwargs) -> Dict:
+        """
+        Raise the load step by step until the server saturates
+
+        The knee is the last step before one of:
+        - p95 latency exceeds ``latency_factor`` times the first step's p95
+          while throughput grows by less than ``min_throughput_gain``
+        - the error rate exceeds ``max_error_rate``
+        """
+        steps = []
+        knee = None
+        stop_reason = 'max_load_reached'
+        load = start
+        while load <= max_load:
+            summary = self.run(mode, load, duration, **kwargs)
+            steps.append(summary)
+            print_summary(summary)
+
+            baseline, previous = steps[0], steps[-2] if len(steps) > 1 else None
+            if summary['error_rate'] > max_error_rate:
+                stop_reason = 'error_rate'
+            elif previous is not None and summary['p95_ms'] and baseline['p95_ms']:
+                gain = (summary['throughput_rps'] - previous['throughput_rps']) / max(previous['throughput_rps'], 1e-9)
+                if summary['p95_ms'] > latency_factor * baseline['p95_ms'] and gain < min_throughput_gain:
+                    stop_reason = 'latency_knee'
+            if stop_reason != 'max_load_reached':
+                knee = previous
+                break
+            load += step
+
+        if knee is None and stop_reason == 'max_load_reached':
+            knee = max(steps, key=lambda s: s['throughput_rps']) if steps else None
+        return {'steps': steps, 'knee': knee, 'stop_reason': stop_reason}
+
+
+def fmt(value: Optional[float]) -> str:
+    """Format a latency in ms; steps with no successful requests have none"""
+    return '   n/a' if value is None else f'{value:7.0f}'
+
+
+def print_summary(summary: Dict):
+    unit = 'clients' if summary['mode'] == 'closed' else 'rps target'
+    print(f"[{summary['mode']} {summary['load']:g} {unit}] "
+          f"throughput={summary['throughput_rps']:.2f} rps "
+          f"p50={fmt(summary['p50_ms'])}ms p95={fmt(summary['p95_ms'])}ms p99={fmt(summary['p99_ms'])}ms "
+          f"errors={summary['errors']}/{summary['requests']} ({summary['error_rate']:.1%})")
+    for endpoint, stats in summary['endpoints'].items():
+        print(f"    {endpoint:<15} n={stats['requests']:<5} "
+              f"p50={fmt(stats['p50_ms'])}ms p95={fmt(stats['p95_ms'])}ms p99={fmt(stats['p99_ms'])}ms "
+              f"errors={stats['error_rate']:.1%}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the Fracture Detection API')
+    parser.add_argument('--url', default='http://localhost:8000', help='Server base URL')
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help='Directory of images to replay')
+    parser.add_argument('--mode', choices=['closed', 'open'], default='closed')
+    parser.add_argument('--concurrency', type=int, default=1, help='Concurrent clients (closed loop)')
+    parser.add_argument('--rps', type=float, default=1.0, help='Target requests per second (open loop)')
+    parser.add_argument('--poisson', action='store_true', help='Poisson arrivals instead of a fixed interval (open loop)')
+    parser.add_argument('--max-in-flight', type=int, default=256, help='Outstanding request cap (open loop)')
+    parser.add_argument('--duration', type=float, default=30.0, help='Seconds per run or per step')
+    parser.add_argument('--mix', default='analyze=1', help='Endpoint weights, e.g. analyze=0.8,counterfactual=0.2')
+    parser.add_argument('--payload', default='{}', help='Extra JSON fields sent with every request')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Per-request timeout in seconds')
+    parser.add_argument('--find-knee', action='store_true', help='Step the load up until saturation')
+    parser.add_argument('--start', type=float, default=1.0, help='First load step')
+    parser.add_argument('--step', type=float, default=1.0, help='Load increment per step')
+    parser.add_argument('--max-load', type=float, default=32.0, help='Highest load step')
+    parser.add_argument('--latency-factor', type=float, default=2.0, help='p95 growth over the first step that marks the knee')
+    parser.add_argument('--max-error-rate', type=float, default=0.01, help='Error rate that ends stepping')
+    parser.add_argument('--json-out', help='Write the full report as JSON')
+    parser.add_argument('--allow-remote', action='store_true', help='Allow targeting a non-local host')
+    args = parser.parse_args(argv)
+
+    host = urllib.parse.urlparse(args.url).hostname
+    if host not in LOCAL_HOSTS and not args.allow_remote:
+        parser.error(f"Refusing to load test non-local host '{host}' (use --allow-remote)")
+
+    generator = LoadGenerator(
+        args.url,
+        load_corpus(args.corpus),
+        parse_mix(args.mix),
+        timeout=args.timeout,
+        extra_payload=json.loads(args.payload)
+    )
+    open_kwargs = {'max_in_flight': args.max_in_flight, 'poisson': args.poisson} if args.mode == 'open' else {}
+
+    if args.find_knee:
+        report = generator.find_knee(
+            args.mode, args.start, args.step, args.max_load, args.duration,
+            latency_factor=args.latency_factor, max_error_rate=args.max_error_rate, **open_kwargs
+        )
+        knee = report['knee']
+        print(f"\nStopped: {report['stop_reason']}")
+        if knee is not None:
+            print(f"Knee at load {knee['load']:g}: {knee['throughput_rps']:.2f} rps, p95 {fmt(knee['p95_ms']).strip()}ms")
+        else:
+            print("Server was saturated at the first step; lower --start")
+    else:
+        load = args.concurrency if args.mode == 'closed' else args.rps
+        report = generator.run(args.mode, load, args.duration, **open_kwargs)
+        print_summary(report)
+
+    if args.json_out:
+        with open(args.json_out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.json_out}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
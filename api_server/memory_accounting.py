@@ -0,0 +1,205 @@
+"""
+Per-Request Memory Accounting
+
+Records how much memory each request leaves behind, overall and (opt-in) per
+pipeline stage (the same stage labels used by ``profiling.profile_stage``):
+- Process RSS (always; read from /proc on Linux)
+- Python allocations traced by ``tracemalloc`` (when tracing is on)
+- Live torch tensor count (when enabled; walks the GC heap, so soak mode only)
+
+Every tracked request prints a ``[memory]`` log line with its deltas.
+"""
+
+import functools
+import gc
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Optional
+
+import torch
+
+from profiling import stage_observer
+
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def current_rss_bytes() -> int:
+    """Resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        # Not Linux: fall back to peak RSS, which only ever grows
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def count_live_tensors() -> int:
+    """Number of torch tensors reachable by the garbage collector"""
+    count = 0
+    for obj in gc.get_objects():
+        try:
+            if isinstance(obj, torch.Tensor):
+                count += 1
+        except Exception:
+            continue
+    return count
+
+
+def format_bytes(value: Optional[float]) -> str:
+    if value is None:
+        return 'n/a'
+    return f'{value / (1024 * 1024):+.2f}MB'
+
+
+class MemorySnapshot:
+    """Point-in-time memory readings"""
+
+    def __init__(self, count_tensors: bool):
+        self.rss = current_rss_bytes()
+        self.traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        self.tensors = count_live_tensors() if count_tensors else None
+
+    def delta(self, before: 'MemorySnapshot') -> Dict:
+        return {
+            'rss_bytes': self.rss - before.rss,
+            'traced_bytes': None if self.traced is None or before.traced is None else self.traced - before.traced,
+            'tensors': None if self.tensors is None or before.tensors is None else self.tensors - before.tensors,
+        }
+
+
+class MemorySession:
+    """Memory deltas for a single request, split by stage"""
+
+    def __init__(self, count_tensors: bool):
+        self.count_tensors = count_tensors
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        before = MemorySnapshot(self.count_tensors)
+        try:
+            yield
+        finally:
+            delta = MemorySnapshot(self.count_tensors).delta(before)
+            totals = self.stages.setdefault(name, {'rss_bytes': 0, 'traced_bytes': None, 'tensors': None})
+            for key, value in delta.items():
+                if value is not None:
+                    totals[key] = (totals[key] or 0) + value
+
+
+class MemoryTracker:
+    """
+    Tracks allocation deltas per request and keeps a short history
+
+    Per-stage deltas read /proc twice per stage, so they are only recorded
+    when ``per_stage`` is set; otherwise stages cost a thread-local lookup.
+    """
+
+    def __init__(self, count_tensors: bool = False, history_size: int = 10000, log: bool = True,
+                 per_stage: bool = False):
+        self.count_tensors = count_tensors
+        self.log = log
+        self.per_stage = per_stage
+        self.history = deque(maxlen=history_size)
+        self._lock = threading.Lock()
+
+    def start_tracing(self, frames: int = 1):
+        """Turn on tracemalloc so Python allocation deltas are recorded"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    @contextmanager
+    def request(self, label: str):
+        """Account the memory a request leaves behind"""
+        session = MemorySession(self.count_tensors)
+        before = MemorySnapshot(self.count_tensors)
+        start = time.perf_counter()
+        try:
+            with stage_observer(session) if self.per_stage else nullcontext():
+                yield session
+        finally:
+            record = {
+                'label': label,
+                'timestamp': time.time(),
+                'duration_ms': (time.perf_counter() - start) * 1000.0,
+                'rss': current_rss_bytes(),
+                'stages': session.stages
+            }
+            record.update(MemorySnapshot(self.count_tensors).delta(before))
+            with self._lock:
+                self.history.append(record)
+            if self.log:
+                self._log(record)
+
+    def tracked(self, label: str):
+        """Decorator that wraps a Flask view in ``request``"""
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                with self.request(label):
+                    return view(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _log(self, record: Dict):
+        line = (f"[memory] {record['label']} rss={format_bytes(record['rss_bytes'])} "
+                f"py={format_bytes(record['traced_bytes'])}")
+        if record['tensors'] is not None:
+            line += f" tensors={record['tensors']:+d}"
+        stages = ', '.join(
+            f"{name}={format_bytes(delta['rss_bytes'])}" for name, delta in record['stages'].items()
+        )
+        if stages:
+            line += f" stages: {stages}"
+        print(line)
+
+
+class PeakMemoryMonitor:
+    """
+    Context manager measuring peak memory growth while it is active
+
+    Uses the CUDA allocator's peak on GPU and a sampling thread over RSS on CPU.
+    """
+
+    def __init__(self, device=None, interval: float = 0.002):
+        self.device = device
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if self._uses_cuda():
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            self._start = torch.cuda.memory_allocated()
+        else:
+            self._start = current_rss_bytes()
+            self._peak = self._start
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._uses_cuda():
+            torch.cuda.synchronize()
+            self.peak_bytes = torch.cuda.max_memory_allocated() - self._start
+        else:
+            self._stop.set()
+            self._thread.join()
+            self._peak = max(self._peak, current_rss_bytes())
+            self.peak_bytes = self._peak - self._start
+        return False
+
+    def _uses_cuda(self) -> bool:
+        return self.device is not None and str(self.device).startswith('cuda')
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._peak = max(self._peak, current_rss_bytes())
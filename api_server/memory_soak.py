@@ -0,0 +1,190 @@
+"""
+Memory Soak Test for the Fracture Detection API
+
+Drives thousands of requests through the Flask app in-process (no network)
+and watches for memory that keeps growing:
+- RSS, tracemalloc-traced Python memory and live torch tensor count,
+  sampled every N requests after a warmup period
+- Per-stage averages from the per-request memory accounting
+- The source lines whose allocations grew the most over the run
+
+Exits with status 1 if any metric keeps growing beyond its threshold, or if
+too many requests fail for the run to mean anything.
+
+Example:
+    python memory_soak.py --requests 2000 --mix analyze=0.9,counterfactual=0.1
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from typing import Dict, List
+
+from load_test import DEFAULT_CORPUS, ENDPOINTS, load_corpus, parse_mix
+from memory_accounting import count_live_tensors, current_rss_bytes
+
+
+def slope(xs: List[float], ys: List[float]) -> float:
+    """Least-squares slope of ys over xs"""
+    n = len(xs)
+    if n < 2:
+        return 0.0
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    if variance == 0:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+
+
+def stage_averages(history: List[Dict]) -> Dict[str, Dict[str, float]]:
+    """Average per-stage deltas across tracked requests"""
+    totals = {}
+    for record in history:
+        for name, delta in record['stages'].items():
+            stage = totals.setdefault(name, {'count': 0, 'rss_bytes': 0.0, 'traced_bytes': 0.0, 'tensors': 0.0})
+            stage['count'] += 1
+            for key in ('rss_bytes', 'traced_bytes', 'tensors'):
+                if delta.get(key) is not None:
+                    stage[key] += delta[key]
+    return {
+        name: {key: stage[key] / stage['count'] for key in ('rss_bytes', 'traced_bytes', 'tensors')}
+        for name, stage in totals.items()
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Memory soak test for the Fracture Detection API')
+    parser.add_argument('--requests', type=int, default=2000, help='Total requests to send')
+    parser.add_argument('--warmup', type=int, default=50, help='Requests before measurement starts')
+    parser.add_argument('--sample-every', type=int, default=25, help='Requests between memory samples')
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help='Directory of images to replay')
+    parser.add_argument('--mix', default='analyze=1', help='Endpoint weights, e.g. analyze=0.9,counterfactual=0.1')
+    parser.add_argument('--max-rss-growth-mb', type=float, default=20.0, help='Allowed RSS growth per 1000 requests')
+    parser.add_argument('--max-traced-growth-mb', type=float, default=5.0, help='Allowed Python heap growth per 1000 requests')
+    parser.add_argument('--max-tensor-growth', type=float, default=10.0, help='Allowed live tensor growth per 1000 requests')
+    parser.add_argument('--max-error-rate', type=float, default=0.01, help='Allowed fraction of non-200 responses')
+    parser.add_argument('--no-tensor-count', action='store_true', help='Skip GC-heap tensor counting (faster)')
+    parser.add_argument('--verbose', action='store_true', help='Print the per-request memory log')
+    parser.add_argument('--json-out', help='Write the full report as JSON')
+    args = parser.parse_args(argv)
+    if args.requests <= args.warmup:
+        parser.error('--requests must be larger than --warmup')
+
+    # The server resolves its model and stores relative to its own directory
+    corpus = os.path.abspath(args.corpus)
+    json_out = os.path.abspath(args.json_out) if args.json_out else None
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import app as server
+
+    # Archiving every request and filling the analysis-handle store up to its
+    # limit would be legitimate growth; keep both out of the measurement
+    server.EMBEDDING_CONFIG['archive_cases'] = False
+    server.analysis_store.max_entries = 0
+    server.memory_tracker.count_tensors = not args.no_tensor_count
+    server.memory_tracker.per_stage = True
+    server.memory_tracker.log = args.verbose
+    server.memory_tracker.start_tracing()
+    if not server.load_model():
+        print("Failed to load model")
+        return 2
+    # Request endpoints answer 503 until warmup has run
+    server.run_warmup()
+
+    images = load_corpus(corpus)
+    mix = parse_mix(args.mix)
+    rng = random.Random(0)
+    client = server.app.test_client()
+
+    samples = []
+    errors = 0
+    baseline_snapshot = None
+    started = time.perf_counter()
+    for i in range(1, args.requests + 1):
+        endpoint = rng.choices(list(mix), weights=list(mix.values()))[0]
+        response = client.post(ENDPOINTS[endpoint], json={'image': rng.choice(images), 'reuse_similar': False})
+        if response.status_code != 200:
+            errors += 1
+
+        if i == args.warmup:
+            gc.collect()
+            baseline_snapshot = tracemalloc.take_snapshot()
+            server.memory_tracker.history.clear()
+        if i >= args.warmup and (i - args.warmup) % args.sample_every == 0:
+            gc.collect()
+            sample = {
+                'request': i,
+                'rss_bytes': current_rss_bytes(),
+                'traced_bytes': tracemalloc.get_traced_memory()[0],
+                'tensors': None if args.no_tensor_count else count_live_tensors()
+            }
+            samples.append(sample)
+            print(f"[soak] {i}/{args.requests} rss={sample['rss_bytes'] / 2**20:.1f}MB "
+                  f"py={sample['traced_bytes'] / 2**20:.1f}MB tensors={sample['tensors']} errors={errors}")
+
+    gc.collect()
+    top_growth = []
+    if baseline_snapshot is not None:
+        for stat in tracemalloc.take_snapshot().compare_to(baseline_snapshot, 'lineno')[:10]:
+            top_growth.append({'location': str(stat.traceback), 'size_diff_bytes': stat.size_diff, 'count_diff': stat.count_diff})
+
+    xs = [sample['request'] for sample in samples]
+    growth = {
+        'rss_mb_per_1000': slope(xs, [s['rss_bytes'] for s in samples]) * 1000 / 2**20,
+        'traced_mb_per_1000': slope(xs, [s['traced_bytes'] for s in samples]) * 1000 / 2**20,
+        'tensors_per_1000': None if args.no_tensor_count else slope(xs, [s['tensors'] for s in samples]) * 1000,
+    }
+    failures = []
+    error_rate = errors / args.requests
+    if error_rate > args.max_error_rate:
+        # Failed requests skip most of the pipeline, so their memory numbers prove nothing
+        failures.append(f"{errors} of {args.requests} requests failed ({error_rate:.1%})")
+    if growth['rss_mb_per_1000'] > args.max_rss_growth_mb:
+        failures.append(f"RSS grows {growth['rss_mb_per_1000']:.1f}MB per 1000 requests")
+    if growth['traced_mb_per_1000'] > args.max_traced_growth_mb:
+        failures.append(f"Python heap grows {growth['traced_mb_per_1000']:.1f}MB per 1000 requests")
+    if growth['tensors_per_1000'] is not None and growth['tensors_per_1000'] > args.max_tensor_growth:
+        failures.append(f"Live tensors grow by {growth['tensors_per_1000']:.0f} per 1000 requests")
+
+    report = {
+        'requests': args.requests,
+        'errors': errors,
+        'error_rate': error_rate,
+        'duration_s': time.perf_counter() - started,
+        'growth': growth,
+        'stages': stage_averages(list(server.memory_tracker.history)),
+        'top_allocation_growth': top_growth,
+        'samples': samples,
+        'failures': failures,
+        'passed': not failures
+    }
+
+    print("\nPer-stage average deltas:")
+    for name, stage in sorted(report['stages'].items()):
+        print(f"  {name:<40} rss={stage['rss_bytes'] / 2**10:+9.1f}KB "
+              f"py={stage['traced_bytes'] / 2**10:+9.1f}KB tensors={stage['tensors']:+.2f}")
+    print("\nLargest allocation growth since warmup:")
+    for entry in top_growth:
+        print(f"  {entry['location']}: {entry['size_diff_bytes'] / 2**10:+.1f}KB ({entry['count_diff']:+d} blocks)")
+    print(f"\nGrowth per 1000 requests: rss={growth['rss_mb_per_1000']:.2f}MB "
+          f"py={growth['traced_mb_per_1000']:.2f}MB tensors={growth['tensors_per_1000']}")
+
+    if json_out:
+        with open(json_out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {json_out}")
+
+    if failures:
+        print("FAILED: " + '; '.join(failures))
+        return 1
+    print("PASSED: no sustained memory growth")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+"""
+Mixed-Precision (bf16 Autocast) Helpers for Explainers
+
+The gradient-heavy explainers (Grad-CAM, SHAP, counterfactual optimization)
+can run their forward and backward passes under bf16 autocast. Inputs,
+optimized perturbations and counterfactual tensors stay fp32; only the
+model's internal compute drops to bf16, and logits are cast back to fp32
+before any loss or softmax is taken.
+"""
+
+from contextlib import contextmanager, nullcontext
+
+import torch
+import torch.nn as nn
+
+
+def autocast(device, enabled: bool = True):
+    """bf16 autocast for ``device`` when enabled, otherwise a no-op context"""
+    if not enabled:
+        return nullcontext()
+    device_type = device.type if isinstance(device, torch.device) else str(device).split(':')[0]
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16)
+
+
+class AutocastModel(nn.Module):
+    """
+    Run a model under bf16 autocast and return fp32 logits
+
+    Libraries that convert outputs with ``.numpy()`` (pytorch-grad-cam, SHAP)
+    cannot handle bf16 tensors, so the wrapper hides the reduced precision.
+    """
+
+    def __init__(self, model: nn.Module, device):
+        super().__init__()
+        self.model = model
+        self.device = device
+
+    def forward(self, x):
+        with autocast(self.device):
+            return self.model(x).float()
+
+
+@contextmanager
+def fp32_activations(layers):
+    """
+    Cast the outputs of ``layers`` to fp32 while active
+
+    Enter this before creating hook-based explainers such as GradCAM so their
+    activation and gradient hooks see fp32 tensors.
+    """
+    handles = [layer.register_forward_hook(lambda module, inputs, output: output.float()) for layer in layers]
+    try:
+        yield
+    finally:
+        for handle in handles:
+            handle.remove()
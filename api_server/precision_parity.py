@@ -0,0 +1,268 @@
+"""
+Mixed-Precision Parity Check for Explainers
+
+Runs every explainer in fp32 and under bf16 autocast on the same images and
+reports, per method:
+- Parity: heatmap correlation (Grad-CAM, SHAP) and agreement of the
+  counterfactual outcome (did the prediction flip, and to which class)
+- Speedup of bf16 over fp32
+- Peak memory of each run and the savings
+
+Timing is fair to both precisions: each method gets an untimed warmup run in
+each precision, and the order of the timed runs alternates between images.
+Peak memory on CPU is measured in a fresh child process per method and
+precision, so neither run benefits from pages the other already made
+resident; on CUDA the allocator's peak is used in-process.
+
+Exits with status 1 if parity falls below the thresholds, so this can gate
+turning on ``PRECISION_CONFIG['mixed_precision']``.
+
+Example:
+    python precision_parity.py --min-correlation 0.9
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+import torch
+import shap
+
+from load_test import DEFAULT_CORPUS, load_corpus
+from memory_accounting import PeakMemoryMonitor
+
+
+HEATMAP_METHODS = ['gradcam', 'shap']
+COUNTERFACTUAL_METHODS = {
+    'counterfactual_adversarial': 'generate_adversarial_counterfactual',
+    'counterfactual_gradient_optimization': 'generate_gradient_based_counterfactual',
+    'counterfactual_mask_based': 'generate_mask_based_counterfactual',
+}
+
+
+def correlation(a: np.ndarray, b: np.ndarray) -> float:
+    """Pearson correlation of two heatmaps"""
+    a = np.asarray(a, dtype=np.float64).ravel()
+    b = np.asarray(b, dtype=np.float64).ravel()
+    if a.std() == 0 or b.std() == 0:
+        return 1.0 if np.allclose(a, b) else 0.0
+    return float(np.corrcoef(a, b)[0, 1])
+
+
+def timed(fn: Callable):
+    """Run ``fn`` and return (result, seconds)"""
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def counterfactual_outcome(result: Dict):
+    """The part of a counterfactual result that must agree across precisions"""
+    if not isinstance(result, dict) or 'error' in result:
+        return ('error',)
+    prediction = result.get('counterfactual_prediction') or {}
+    return (bool(result.get('success')), prediction.get('predicted_class'))
+
+
+def load_server():
+    """Import the server from its own directory and load the model in fp32"""
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import app as server
+    server.PRECISION_CONFIG['mixed_precision'] = False
+    if not server.load_model():
+        return None
+    return server
+
+
+def build_runners(server, methods: List[str]) -> Dict[str, Callable]:
+    """Map each method to ``run(input_tensor, predicted_class, seed, mixed)``"""
+    from counterfactual_explainer import CounterfactualExplainer
+    from mixed_precision import AutocastModel
+
+    model, device, size = server.model, server.device, server.MODEL_CONFIG['input_size']
+    runners = {}
+    if 'gradcam' in methods:
+        runners['gradcam'] = lambda input_tensor, predicted_class, seed, mixed: server.generate_gradcam(
+            model, input_tensor, predicted_class, mixed_precision=mixed)[1]
+    if 'shap' in methods:
+        torch.manual_seed(0)
+        background = torch.randn(5, 3, size, size).to(device)
+        shap_explainers = {
+            False: shap.GradientExplainer(model, background),
+            True: shap.GradientExplainer(AutocastModel(model, device), background),
+        }
+
+        def run_shap(input_tensor, predicted_class, seed, mixed):
+            # GradientExplainer samples randomly; use the same draws for both precisions
+            torch.manual_seed(seed)
+            np.random.seed(seed)
+            return server.compute_shap_heatmap(input_tensor, predicted_class, explainer=shap_explainers[mixed])
+        runners['shap'] = run_shap
+    cf_methods = [name for name in methods if name in COUNTERFACTUAL_METHODS]
+    if cf_methods:
+        cf_explainers = {
+            mixed: CounterfactualExplainer(model, device, size, mixed_precision=mixed,
+                                           mean=server.NORMALIZE_MEAN, std=server.NORMALIZE_STD)
+            for mixed in (False, True)
+        }
+        for name in cf_methods:
+            def run_counterfactual(input_tensor, predicted_class, seed, mixed, method=COUNTERFACTUAL_METHODS[name]):
+                return getattr(cf_explainers[mixed], method)(input_tensor, 1 - predicted_class)
+            runners[name] = run_counterfactual
+    return runners
+
+
+def prepare(server, image: str):
+    input_tensor, _ = server.preprocess_image(image)
+    with torch.no_grad():
+        predicted_class = server.model(input_tensor).argmax(dim=1).item()
+    return input_tensor, predicted_class
+
+
+def child_peak(method: str, mixed: bool, corpus: str, index: int) -> int:
+    """Entry point of the child process: peak memory of one cold run"""
+    server = load_server()
+    if server is None:
+        raise RuntimeError("Failed to load model")
+    runner = build_runners(server, [method])[method]
+    input_tensor, predicted_class = prepare(server, load_corpus(corpus)[index])
+    with PeakMemoryMonitor(server.device) as monitor:
+        runner(input_tensor, predicted_class, index, mixed)
+    return monitor.peak_bytes
+
+
+def isolated_peak(method: str, mixed: bool, corpus: str, index: int) -> int:
+    """Peak memory of one run in a fresh process, so no earlier run's pages are resident"""
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--corpus', corpus,
+         '--child', method, '--child-mixed', str(int(mixed)), '--child-image', str(index)],
+        check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])['peak_bytes']
+
+
+def summarize(entries: List[Dict], peaks: Dict[bool, int]) -> Dict:
+    fp32_time = float(np.mean([e['fp32_seconds'] for e in entries]))
+    bf16_time = float(np.mean([e['bf16_seconds'] for e in entries]))
+    summary = {
+        'runs': len(entries),
+        'fp32_ms': fp32_time * 1000.0,
+        'bf16_ms': bf16_time * 1000.0,
+        'speedup': fp32_time / bf16_time if bf16_time > 0 else None,
+        'fp32_peak_mb': peaks[False] / 2**20,
+        'bf16_peak_mb': peaks[True] / 2**20,
+        'memory_saved_mb': (peaks[False] - peaks[True]) / 2**20,
+    }
+    if 'correlation' in entries[0]:
+        summary['mean_correlation'] = float(np.mean([e['correlation'] for e in entries]))
+        summary['min_correlation'] = float(np.min([e['correlation'] for e in entries]))
+    if 'agree' in entries[0]:
+        summary['outcome_agreement'] = float(np.mean([e['agree'] for e in entries]))
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare fp32 and bf16 autocast explainers')
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help='Directory of images to check')
+    parser.add_argument('--min-correlation', type=float, default=0.9, help='Minimum heatmap correlation')
+    parser.add_argument('--min-agreement', type=float, default=1.0, help='Minimum counterfactual outcome agreement')
+    parser.add_argument('--skip-counterfactuals', action='store_true', help='Only check Grad-CAM and SHAP')
+    parser.add_argument('--json-out', help='Write the full report as JSON')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--child-mixed', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--child-image', type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    # The server resolves its model relative to its own directory
+    corpus = os.path.abspath(args.corpus)
+    json_out = os.path.abspath(args.json_out) if args.json_out else None
+
+    if args.child:
+        print(json.dumps({'peak_bytes': child_peak(args.child, bool(args.child_mixed), corpus, args.child_image)}))
+        return 0
+
+    server = load_server()
+    if server is None:
+        print("Failed to load model")
+        return 2
+    methods = HEATMAP_METHODS + ([] if args.skip_counterfactuals else list(COUNTERFACTUAL_METHODS))
+    runners = build_runners(server, methods)
+    images = load_corpus(corpus)
+
+    # Untimed warmup of every method in both precisions
+    input_tensor, predicted_class = prepare(server, images[0])
+    for name, run in runners.items():
+        for mixed in (False, True):
+            run(input_tensor, predicted_class, 0, mixed)
+
+    results = {name: [] for name in runners}
+    for index, image in enumerate(images):
+        input_tensor, predicted_class = prepare(server, image)
+        print(f"Image {index + 1}: predicted class {predicted_class}")
+        # Alternate which precision runs first so neither always pays for the other
+        order = (False, True) if index % 2 == 0 else (True, False)
+        for name, run in runners.items():
+            runs = {}
+            for mixed in order:
+                runs[mixed] = timed(lambda: run(input_tensor, predicted_class, index, mixed))
+            entry = {'fp32_seconds': runs[False][1], 'bf16_seconds': runs[True][1]}
+            if name in HEATMAP_METHODS:
+                if runs[False][0] is None or runs[True][0] is None:
+                    continue
+                entry['correlation'] = correlation(runs[False][0], runs[True][0])
+            else:
+                entry['fp32_outcome'] = counterfactual_outcome(runs[False][0])
+                entry['bf16_outcome'] = counterfactual_outcome(runs[True][0])
+                entry['agree'] = entry['fp32_outcome'] == entry['bf16_outcome']
+            results[name].append(entry)
+
+    # Peak memory of one cold run on the first image per method and precision
+    peaks = {}
+    for name in runners:
+        if not results[name]:
+            continue
+        if str(server.device).startswith('cuda'):
+            input_tensor, predicted_class = prepare(server, images[0])
+            peaks[name] = {}
+            for mixed in (False, True):
+                with PeakMemoryMonitor(server.device) as monitor:
+                    runners[name](input_tensor, predicted_class, 0, mixed)
+                peaks[name][mixed] = monitor.peak_bytes
+        else:
+            peaks[name] = {mixed: isolated_peak(name, mixed, corpus, 0) for mixed in (False, True)}
+
+    report = {name: summarize(entries, peaks[name]) for name, entries in results.items() if entries}
+    failures = []
+    print(f"\n{'method':<40} {'fp32 ms':>9} {'bf16 ms':>9} {'speedup':>8} {'mem saved':>10}  parity")
+    for name, summary in report.items():
+        if 'mean_correlation' in summary:
+            parity = f"corr mean {summary['mean_correlation']:.3f} min {summary['min_correlation']:.3f}"
+            if summary['min_correlation'] < args.min_correlation:
+                failures.append(f"{name} heatmap correlation {summary['min_correlation']:.3f}")
+        else:
+            parity = f"outcome agreement {summary['outcome_agreement']:.0%}"
+            if summary['outcome_agreement'] < args.min_agreement:
+                failures.append(f"{name} outcome agreement {summary['outcome_agreement']:.0%}")
+        speedup = f"{summary['speedup']:.2f}x" if summary['speedup'] else 'n/a'
+        print(f"{name:<40} {summary['fp32_ms']:>9.0f} {summary['bf16_ms']:>9.0f} {speedup:>8} "
+              f"{summary['memory_saved_mb']:>8.1f}MB  {parity}")
+
+    if json_out:
+        with open(json_out, 'w') as f:
+            json.dump({'summary': report, 'runs': results, 'failures': failures}, f, indent=2, default=str)
+        print(f"Report written to {json_out}")
+
+    if failures:
+        print("FAILED: " + '; '.join(failures))
+        return 1
+    print("PASSED: bf16 autocast matches fp32")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
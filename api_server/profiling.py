@@ -0,0 +1,269 @@
+"""
+On-Demand Request Profiling
+
+Captures the next N requests with ``torch.profiler`` plus a lightweight
+Python stack sampler, labeled by pipeline stage (preprocessing, forward pass,
+each explainer, each counterfactual method, encoding). Each captured request
+writes:
+- ``<name>.trace.json``  Chrome trace (open in chrome://tracing or Perfetto)
+- ``<name>.folded``      collapsed stacks for flamegraph.pl or speedscope
+
+Other per-request observers (e.g. memory accounting) can attach to the same
+stage labels with ``stage_observer``. When nothing is attached,
+``profile_stage`` returns a shared no-op context manager, so instrumented
+code pays only a thread-local lookup. Each attached observer adds its own
+per-stage cost: ``StageCostTracker`` (always attached to ``/analyze``) takes
+two ``perf_counter`` readings, a lock and an average update per stage.
+"""
+
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager, nullcontext
+from typing import Dict, List
+
+import torch
+
+
+_NULL_CONTEXT = nullcontext()
+_local = threading.local()
+
+
+def profile_stage(name: str):
+    """Label a pipeline stage of the request currently being handled"""
+    observers = getattr(_local, 'observers', None)
+    if not observers:
+        return _NULL_CONTEXT
+    if len(observers) == 1:
+        return observers[0].stage(name)
+    return _observe_stage(list(observers), name)
+
+
+@contextmanager
+def _observe_stage(observers, name: str):
+    with ExitStack() as stack:
+        for observer in observers:
+            stack.enter_context(observer.stage(name))
+        yield
+
+
+@contextmanager
+def stage_observer(observer):
+    """
+    Attach an object with a ``stage(name)`` context manager method to the
+    stages of the current thread's request
+    """
+    observers = getattr(_local, 'observers', None)
+    if observers is None:
+        observers = _local.observers = []
+    observers.append(observer)
+    try:
+        yield observer
+    finally:
+        observers.remove(observer)
+
+
+class StackSampler:
+    """
+    Periodically sample the Python stack of one thread into folded stacks
+    """
+
+    def __init__(self, thread_id: int, stage_stack: List[str], interval: float = 0.005):
+        self.thread_id = thread_id
+        self.stage_stack = stage_stack
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            frames.reverse()
+            stages = [f'stage:{stage}' for stage in tuple(self.stage_stack)]
+            self.samples[';'.join(stages + frames)] += 1
+
+    def write_folded(self, path: str):
+        with open(path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+class ProfileSession:
+    """Profiling state for a single captured request"""
+
+    def __init__(self, sample_interval: float):
+        self.stage_stack = []
+        self.stage_times = {}
+        self.sampler = StackSampler(threading.get_ident(), self.stage_stack, sample_interval)
+
+    @contextmanager
+    def stage(self, name: str):
+        self.stage_stack.append(name)
+        start = time.perf_counter()
+        try:
+            with torch.profiler.record_function(name):
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stage_times[name] = self.stage_times.get(name, 0.0) + elapsed
+            self.stage_stack.pop()
+
+
+class RequestProfiler:
+    """
+    Arms profiling for the next N requests and writes their traces
+    """
+
+    def __init__(self, output_dir: str = 'profiles', sample_interval: float = 0.005):
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self._remaining = 0
+        self._lock = threading.Lock()
+        # torch.profiler is process-wide, so only one request is captured at a time
+        self._capture_lock = threading.Lock()
+        self.captures = []
+
+    def arm(self, requests: int) -> int:
+        """Profile the next ``requests`` requests; returns the number still pending"""
+        with self._lock:
+            self._remaining = max(0, int(requests))
+            return self._remaining
+
+    def status(self) -> Dict:
+        return {
+            'remaining': self._remaining,
+            'output_dir': os.path.abspath(self.output_dir),
+            'captures': self.captures[-20:]
+        }
+
+    def _claim(self) -> bool:
+        if self._remaining <= 0:
+            return False
+        if not self._capture_lock.acquire(blocking=False):
+            return False
+        with self._lock:
+            if self._remaining <= 0:
+                self._capture_lock.release()
+                return False
+            self._remaining -= 1
+        return True
+
+    @contextmanager
+    def capture(self, label: str):
+        """Profile the enclosed request if a capture is armed"""
+        if not self._claim():
+            yield None
+            return
+        try:
+            session = ProfileSession(self.sample_interval)
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            profiler = torch.profiler.profile(activities=activities, profile_memory=True)
+            session.sampler.start()
+            start = time.perf_counter()
+            try:
+                with profiler, stage_observer(session):
+                    with session.stage(label):
+                        yield session
+            finally:
+                session.sampler.stop()
+                self._write(label, session, profiler, time.perf_counter() - start)
+        finally:
+            self._capture_lock.release()
+
+    def profiled(self, label: str):
+        """Decorator that wraps a Flask view in ``capture``"""
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                with self.capture(label):
+                    return view(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _write(self, label: str, session: ProfileSession, profiler, elapsed: float):
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}_{label}_{int(time.time() * 1000) % 1000:03d}"
+            trace_path = os.path.join(self.output_dir, f'{name}.trace.json')
+            folded_path = os.path.join(self.output_dir, f'{name}.folded')
+            profiler.export_chrome_trace(trace_path)
+            session.sampler.write_folded(folded_path)
+            capture = {
+                'label': label,
+                'duration_ms': elapsed * 1000.0,
+                'stage_ms': {stage: t * 1000.0 for stage, t in session.stage_times.items()},
+                'chrome_trace': trace_path,
+                'flamegraph': folded_path
+            }
+            self.captures.append(capture)
+            print(f"Profile captured for {label}: {trace_path}, {folded_path}")
+        except Exception as e:
+            print(f"Error writing profile for {label}: {e}")
+
+
+class StageCostTracker:
+    """
+    Typical duration of each stage across requests (exponentially weighted)
+    """
+
+    def __init__(self, smoothing: float = 0.2):
+        self.smoothing = smoothing
+        self._typical = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            previous = self._typical.get(name)
+            if previous is None:
+                self._typical[name] = seconds
+            else:
+                self._typical[name] = previous + self.smoothing * (seconds - previous)
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def typical_ms(self, *stages: str):
+        """Summed typical duration of ``stages`` in ms, or None if any is unmeasured"""
+        with self._lock:
+            if any(stage not in self._typical for stage in stages):
+                return None
+            return sum(self._typical[stage] for stage in stages) * 1000.0
+
+    def samples(self, stage: str) -> int:
+        with self._lock:
+            return self._counts.get(stage, 0)
+
+    def tracked(self, view):
+        """Decorator that times the stages of a Flask view"""
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with stage_observer(self):
+                return view(*args, **kwargs)
+        return wrapper
@@ -844,7 +844,7 @@ const AnalysisResults: React.FC<AnalysisResultsProps> = ({
             </button>
             {expandedSections.has('counterfactual') && (
               <div className="mt-4">
-                <CounterfactualAnalysis imageData={patientData.xrayImage} />
+                <CounterfactualAnalysis imageData={patientData.xrayImage} analysisHandle={analysisResult?.analysisHandle} />
               </div>
             )}
           </div>
@@ -47,9 +47,10 @@ interface CounterfactualResults {
 
 interface CounterfactualAnalysisProps {
   imageData: File;
+  analysisHandle?: string;
 }
 
-const CounterfactualAnalysis: React.FC<CounterfactualAnalysisProps> = ({ imageData }) => {
+const CounterfactualAnalysis: React.FC<CounterfactualAnalysisProps> = ({ imageData, analysisHandle }) => {
   const [results, setResults] = useState<CounterfactualResults | null>(null);
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState<string | null>(null);
@@ -94,14 +95,22 @@ const CounterfactualAnalysis: React.FC<CounterfactualAnalysisProps> = ({ imageDa
     setResults(null);
 
     try {
-      const response = await fetch('http://localhost:8000/counterfactual', {
+      const requestCounterfactual = (body: object) => fetch('http://localhost:8000/counterfactual', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
         },
-        body: JSON.stringify({ image: base64Image }),
+        body: JSON.stringify(body),
       });
 
+      // Reuse the server-side /analyze result; fall back to re-uploading if the handle expired
+      let response = analysisHandle
+        ? await requestCounterfactual({ analysis_handle: analysisHandle })
+        : await requestCounterfactual({ image: base64Image });
+      if (analysisHandle && response.status === 404) {
+        response = await requestCounterfactual({ image: base64Image });
+      }
+
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
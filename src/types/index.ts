@@ -20,6 +20,7 @@ export interface AnalysisResult {
   timestamp: string;
   detailedAnalysis?: DetailedAnalysisResult;
   shapExplanation?: ShapExplanation;
+  analysisHandle?: string; // Short-lived server handle reusable by /counterfactual
 }
 
 export interface ShapExplanation {
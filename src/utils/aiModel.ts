@@ -144,6 +144,7 @@ export const analyzeXray = async (patientData: import('../types').PatientData):
     timestamp: new Date().toISOString(),
     detailedAnalysis,
     shapExplanation,
+    analysisHandle: result.analysis_handle,
     groundTruth: result.ground_truth, // if provided by API
     correct: result.correct, // if provided by API
     patientMeta: result.patient_meta // if provided by API